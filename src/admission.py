@@ -0,0 +1,165 @@
+''' admission.py contains the process wide admission control in front of every Amazon Bedrock model call of RAG_Chatbot'''
+''' Each model has a requests-per-minute and a tokens-per-minute token bucket sized to the account quotas. Calls wait in fair queues: '''
+''' interactive work (questions) goes ahead of background work (summaries, document embeddings) and sessions take turns within a class'''
+
+import time # Import time to refill the buckets and measure waits
+import threading # Import threading for the queue condition
+import contextvars # Import contextvars to carry the session and class of a request across threads and the event loop
+from collections import OrderedDict, deque # Import OrderedDict and deque for the per session queues
+from contextlib import contextmanager # Import contextmanager for request_class
+from configparser import ConfigParser # Import ConfigParser library for reading the quotas
+
+config_object = ConfigParser()
+config_object.read("config.ini")
+admission_enabled=config_object.getboolean("QUOTAS","enabled",fallback=True)
+default_rpm=config_object.getint("QUOTAS","default_rpm",fallback=500) # Requests per minute of models without their own quota
+default_tpm=config_object.getint("QUOTAS","default_tpm",fallback=1000000) # Tokens per minute of models without their own quota
+# Other options of [QUOTAS] set the quota of one model as "model id, rpm, tpm" #
+model_quotas={}
+for option, value in (config_object.items("QUOTAS") if config_object.has_section("QUOTAS") else []):
+    if option not in ("enabled", "default_rpm", "default_tpm"):
+        model_id, rpm, tpm = [part.strip() for part in value.split(",")]
+        model_quotas[model_id] = (int(rpm), int(tpm))
+chars_per_token=4 # Rough estimate used before a call, good enough for admission #
+'''_________________________________________________________________________________________________________________'''
+
+
+_session = contextvars.ContextVar("bedrock_session", default="shared")
+_request = contextvars.ContextVar("bedrock_request", default=(True, 1)) # (interactive, estimated tokens) #
+
+#set_session function to attribute the Bedrock calls of the current thread (and the work it fans out) to a session
+def set_session(session_id):
+    _session.set(session_id or "shared")
+
+
+#request_class context manager to mark the Bedrock calls made inside it as interactive or background, with their estimated tokens
+@contextmanager
+def request_class(interactive, tokens):
+    reset = _request.set((interactive, tokens))
+    try:
+        yield
+    finally:
+        _request.reset(reset)
+
+
+#estimate_tokens function to estimate the tokens of a text without tokenizing it
+def estimate_tokens(text):
+    return len(text) // chars_per_token + 1
+'''_________________________________________________________________________________________________________________'''
+
+
+# TokenBucket refills continuously at per_minute / 60 per second up to per_minute #
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def wait_time(self, n): # Seconds until n can be taken, 0 if now #
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        n = min(n, self.capacity) # A request larger than the bucket waits for a full bucket #
+        return 0.0 if self.level >= n else (n - self.level) / self.rate
+
+    def take(self, n):
+        self.level -= min(n, self.capacity)
+
+
+# ModelScheduler admits the calls of one model in fair order when both of its buckets allow #
+# Queues: class (0 interactive, 1 background) -> session -> tickets, the next ticket is the oldest of the first session of the most urgent class #
+# A session that is admitted moves to the back of its class, so sessions take turns #
+class ModelScheduler:
+    def __init__(self, model_id, rpm, tpm):
+        self.model_id = model_id
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.queues = {0: OrderedDict(), 1: OrderedDict()}
+        self.condition = threading.Condition()
+        self.admitted = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def admit(self, session, interactive, tokens, deadline): # Block until the call may be sent, TimeoutError at the deadline #
+        priority = 0 if interactive else 1
+        ticket = object()
+        start = time.time()
+        with self.condition:
+            self.queues[priority].setdefault(session, deque()).append(ticket)
+            try:
+                while True:
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        raise TimeoutError(f"{self.model_id} quota did not admit the call before the deadline")
+                    if self._next() is ticket:
+                        wait = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+                        if wait <= 0:
+                            self.requests.take(1)
+                            self.tokens.take(tokens)
+                            break
+                        timeout = min(timeout, wait)
+                    self.condition.wait(timeout)
+            finally:
+                self._remove(priority, session, ticket)
+                self.condition.notify_all()
+            waited = time.time() - start
+            self.admitted += 1
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        return waited
+
+    def _next(self):
+        for priority in (0, 1):
+            for tickets in self.queues[priority].values():
+                return tickets[0]
+        return None
+
+    def _remove(self, priority, session, ticket):
+        sessions = self.queues[priority]
+        sessions[session].remove(ticket)
+        if sessions[session]:
+            sessions.move_to_end(session)
+        else:
+            del sessions[session]
+
+    def stats(self):
+        with self.condition:
+            return {'queued_interactive': sum(len(t) for t in self.queues[0].values()),
+                    'queued_background': sum(len(t) for t in self.queues[1].values()),
+                    'sessions_waiting': len(self.queues[0]) + len(self.queues[1]),
+                    'admitted': self.admitted, 'avg_wait_ms': round(self.wait_seconds / self.admitted * 1000, 1) if self.admitted else 0.0,
+                    'max_wait_ms': round(self.max_wait_seconds * 1000, 1),
+                    'rpm': self.requests.capacity, 'tpm': self.tokens.capacity}
+'''_________________________________________________________________________________________________________________'''
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+#get_scheduler function to return the scheduler of a model, created with its quota on first use
+def get_scheduler(model_id):
+    with _schedulers_lock:
+        if model_id not in _schedulers:
+            rpm, tpm = model_quotas.get(model_id, (default_rpm, default_tpm))
+            _schedulers[model_id] = ModelScheduler(model_id, rpm, tpm)
+        return _schedulers[model_id]
+
+
+#admit function to wait until a call to a model is admitted, for the session and request class of the current context
+#parameters: "deadline" is the time.time() by which the call must be admitted
+def admit(model_id, deadline):
+    if not admission_enabled:
+        return
+    interactive, tokens = _request.get()
+    waited = get_scheduler(model_id).admit(_session.get(), interactive, tokens, deadline)
+    if waited > 1:
+        print(f"Waited {waited:.1f}s for {model_id} quota ({'interactive' if interactive else 'background'}, {tokens} tokens): {get_scheduler(model_id).stats()}")
+
+
+#stats function to return queue depth, waits and quotas of every model used so far
+def stats():
+    with _schedulers_lock:
+        schedulers = dict(_schedulers)
+    return {model_id: scheduler.stats() for model_id, scheduler in schedulers.items()}
+'''_________________________________________________________________________________________________________________'''
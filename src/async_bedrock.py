@@ -0,0 +1,92 @@
+''' async_bedrock.py contains the asyncio surface used to fan out Amazon Bedrock calls of RAG_Chatbot'''
+''' Coroutines run on one event loop thread per process, shared by all sessions. Blocking boto3 calls run on a bounded executor '''
+''' and a semaphore per kind of call (llm, summary, embed) bounds how many of them are in flight'''
+
+import asyncio # Import asyncio for the event loop, tasks and semaphores
+import functools # Import functools to pass arguments to the executor
+import contextvars # Import contextvars to run the blocking calls in the context (session, request class) of the caller
+import threading # Import threading to run the event loop
+from concurrent.futures import ThreadPoolExecutor # Import ThreadPoolExecutor to run the blocking boto3 calls
+from configparser import ConfigParser # Import ConfigParser library for reading the concurrency settings
+
+config_object = ConfigParser()
+config_object.read("config.ini")
+max_in_flight=config_object.getint("ASYNC","max_in_flight",fallback=256) # Blocking calls running at once in the process
+concurrency={ # Calls of each kind in flight at once #
+    'llm': config_object.getint("ASYNC","llm_concurrency",fallback=32), # Answers to questions
+    'summary': config_object.getint("SUMMARY","max_concurrency",fallback=4), # Chunk summaries and their reduction
+    'embed': config_object.getint("EMBEDDINGS","max_concurrency",fallback=8), # Document and question embeddings
+}
+'''_________________________________________________________________________________________________________________'''
+
+
+_loop = None
+_loop_lock = threading.Lock()
+_semaphores = {} # Created on the loop thread, see _semaphore #
+
+#get_loop function to return the event loop of the process, started on a daemon thread on first use
+def get_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            _loop.set_default_executor(ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="bedrock-async"))
+            threading.Thread(target=_loop.run_forever, name="bedrock-event-loop", daemon=True).start()
+        return _loop
+
+
+#submit function to schedule a coroutine on the event loop from any thread
+#returns: concurrent.futures.Future, so synchronous code can wait on it, use as_completed or cancel it
+def submit(coro):
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+
+#run function to run a coroutine on the event loop and wait for its result
+def run(coro):
+    return submit(coro).result()
+
+
+#_semaphore function to return the semaphore of a kind of call, only called on the loop thread
+def _semaphore(kind):
+    if kind not in _semaphores:
+        _semaphores[kind] = asyncio.Semaphore(concurrency[kind])
+    return _semaphores[kind]
+'''_________________________________________________________________________________________________________________'''
+
+
+#acall coroutine to run a blocking Bedrock call (boto3, or a function built on it) once a slot of its kind is free
+#parameters: "kind" is llm, summary or embed, "fn" is called with the remaining arguments
+#returns: the result of fn
+async def acall(kind, fn, *args, **kwargs):
+    async with _semaphore(kind):
+        context = contextvars.copy_context() # The task runs in a copy of the submitting thread's context #
+        return await asyncio.get_running_loop().run_in_executor(None, context.run, functools.partial(fn, *args, **kwargs))
+
+
+#astream async generator to consume a blocking stream (e.g. bedrock_llm_stream) without blocking the event loop
+#the stream holds one slot of its kind until it ends
+async def astream(kind, iterable):
+    loop = asyncio.get_running_loop()
+    done = object()
+    async with _semaphore(kind):
+        context = contextvars.copy_context()
+        iterator = await loop.run_in_executor(None, context.run, iter, iterable)
+        while True:
+            item = await loop.run_in_executor(None, context.run, next, iterator, done)
+            if item is done:
+                return
+            yield item
+
+
+#agather coroutine to run calls of one kind concurrently, each one holding a slot of its kind
+#parameters: "calls" is a list of (fn, args) pairs
+#returns: the results in the order of the calls
+async def agather(kind, calls):
+    return await asyncio.gather(*(acall(kind, fn, *args) for fn, args in calls))
+
+
+#gather function to run agather from synchronous code and wait for all of the calls
+#must not be called from inside a call holding a slot of the same kind, the outer calls could hold every slot
+def gather(kind, calls):
+    return run(agather(kind, calls))
+'''_________________________________________________________________________________________________________________'''
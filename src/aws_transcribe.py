@@ -1,8 +1,8 @@
-import boto3
 import time
 import pandas as pd
+from clients import get_client
 
-transcribe = boto3.client('transcribe')
+transcribe = get_client('transcribe')
 audio_file_name = "Sample_Audio_Test_Transcribe.m4a"
 
 
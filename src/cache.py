@@ -0,0 +1,244 @@
+''' cache.py consists of the persistent caches shared by all sessions and replicas of RAG_Chatbot'''
+''' Entries are stored in SQLite files on local disk, so they survive restarts and can be shared by replicas on the same volume'''
+
+import os # Import os to create the cache directory
+import time # Import time for access times and expiry
+import pickle # Import pickle to store python values as blobs
+import sqlite3 # Import sqlite3 as the on-disk store
+import hashlib # Import hashlib to build content addressed keys
+import threading # Import threading to guard the connection shared by sessions
+import numpy as np # Import numpy for question similarity in the answer cache
+from configparser import ConfigParser # Import ConfigParser library for reading the cache settings
+
+config_object = ConfigParser()
+config_object.read("config.ini")
+cache_dir=config_object.get("CACHE","cache_dir",fallback="./cache") # Directory holding all cache files
+'''_________________________________________________________________________________________________________________'''
+
+
+#content_hash function to build a content addressed key
+#parameters: "parts" can be bytes, strings, uploaded files (anything with getvalue) or lists of these
+#returns: hex sha256 digest of all parts
+def content_hash(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, (list, tuple)):
+            part = content_hash(*part)
+        elif hasattr(part, "getvalue"): # Streamlit UploadedFile #
+            part = part.getvalue()
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        digest.update(len(part).to_bytes(8, "big")) # Length prefix so that ("ab","c") and ("a","bc") differ #
+        digest.update(part)
+    return digest.hexdigest()
+'''_________________________________________________________________________________________________________________'''
+
+
+# DiskCache is a size bounded key/value store with least recently used eviction #
+# Values are pickled, keys are strings (usually built with content_hash) #
+# hits and misses are counted per process and reported by stats() #
+class DiskCache:
+    def __init__(self, name, max_bytes):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.name = name
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(cache_dir, name + ".sqlite"), check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL") # Readers and a writer from other replicas do not block each other #
+        self._db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB, size INTEGER, accessed REAL, expires REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+        self._db.commit()
+
+    def get(self, key, default=None): # Return the cached value or default, refreshing the entry's recency #
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT value, expires FROM entries WHERE key=?", (key,)).fetchone()
+            if row is None or (row[1] is not None and row[1] < now):
+                self.misses += 1
+                return default
+            self._db.execute("UPDATE entries SET accessed=? WHERE key=?", (now, key))
+            self._db.commit()
+            self.hits += 1
+        return pickle.loads(row[0])
+
+    def get_many(self, keys): # Return a dict of the keys found, in one transaction #
+        now = time.time()
+        found = {}
+        with self._lock:
+            for key in keys:
+                row = self._db.execute("SELECT value, expires FROM entries WHERE key=?", (key,)).fetchone()
+                if row is None or (row[1] is not None and row[1] < now):
+                    self.misses += 1
+                    continue
+                self._db.execute("UPDATE entries SET accessed=? WHERE key=?", (now, key))
+                self.hits += 1
+                found[key] = row[0]
+            self._db.commit()
+        return {key: pickle.loads(blob) for key, blob in found.items()}
+
+    def set_many(self, items, ttl=None): # Store a dict of values in one transaction #
+        now = time.time()
+        expires = now + ttl if ttl else None
+        rows = []
+        for key, value in items.items():
+            blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            if len(blob) <= self.max_bytes:
+                rows.append((key, blob, len(blob), now, expires))
+        with self._lock:
+            self._db.executemany("REPLACE INTO entries (key, value, size, accessed, expires) VALUES (?,?,?,?,?)", rows)
+            self._evict()
+            self._db.commit()
+
+    def set(self, key, value, ttl=None): # Store a value, evicting least recently used entries beyond max_bytes #
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(blob) > self.max_bytes: # Never cache something that would evict everything else #
+            return
+        now = time.time()
+        expires = now + ttl if ttl else None
+        with self._lock:
+            self._db.execute("REPLACE INTO entries (key, value, size, accessed, expires) VALUES (?,?,?,?,?)", (key, blob, len(blob), now, expires))
+            self._evict()
+            self._db.commit()
+
+    def delete(self, key):
+        with self._lock:
+            self._db.execute("DELETE FROM entries WHERE key=?", (key,))
+            self._db.commit()
+
+    def _evict(self): # Drop expired entries, then the least recently used ones until the cache fits #
+        self._db.execute("DELETE FROM entries WHERE expires IS NOT NULL AND expires<?", (time.time(),))
+        total = self._db.execute("SELECT COALESCE(SUM(size),0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self._db.execute("SELECT key, size FROM entries ORDER BY accessed").fetchall():
+            self._db.execute("DELETE FROM entries WHERE key=?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def stats(self): # Hit/miss counters of this process and the current size of the cache #
+        with self._lock:
+            entries, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size),0) FROM entries").fetchone()
+        lookups = self.hits + self.misses
+        return {'name': self.name, 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0, 'entries': entries, 'bytes': size}
+'''_________________________________________________________________________________________________________________'''
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+#get_cache function to return the process wide cache with the given name
+#the size bound is read from the [CACHE] section of config.ini as <name>_max_mb
+def get_cache(name, default_max_mb=512):
+    with _caches_lock:
+        if name not in _caches:
+            max_mb = config_object.getint("CACHE", name+"_max_mb", fallback=default_max_mb)
+            _caches[name] = DiskCache(name, max_mb * 1024 * 1024)
+        return _caches[name]
+'''_________________________________________________________________________________________________________________'''
+
+
+# SingleFlight runs at most one computation per key at a time in this process, concurrent callers with the same key wait for it #
+# and share its result, e.g. two sessions uploading or summarizing the same document send the Bedrock/Textract/Transcribe calls once #
+# Errors are raised to every waiting caller. None results (cancelled work) are not shared, a waiting caller then runs the computation itself #
+# A BaseException of the leader (e.g. a Streamlit rerun or stop of its session) cancels the call: it is raised in the leader only #
+class SingleFlight:
+    def __init__(self):
+        self.led = 0 # Computations run #
+        self.shared = 0 # Callers served by another caller's computation #
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args): # Return fn(*args), or the result of the call already running under key #
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self._calls[key] = {'done': threading.Event(), 'result': None, 'error': None}
+                    self.led += 1
+            if leader:
+                try:
+                    call['result'] = fn(*args)
+                    return call['result']
+                except Exception as e:
+                    call['error'] = e
+                    raise
+                finally:
+                    with self._lock:
+                        del self._calls[key]
+                    call['done'].set()
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            if call['result'] is not None:
+                with self._lock:
+                    self.shared += 1
+                return call['result']
+
+    def in_flight(self, key):
+        with self._lock:
+            return key in self._calls
+
+    def stats(self):
+        with self._lock:
+            return {'led': self.led, 'shared': self.shared, 'in_flight': len(self._calls)}
+
+
+single_flight = SingleFlight()
+'''_________________________________________________________________________________________________________________'''
+
+
+# SemanticAnswerCache stores answers to document questions and serves them again for near-duplicate questions #
+# Entries are grouped per (document hash, model id, inference params) and matched by cosine similarity of the question vectors #
+# Entries expire after ttl seconds, groups are evicted least recently used through the underlying DiskCache #
+class SemanticAnswerCache:
+    def __init__(self, store, threshold, ttl, max_entries):
+        self.store = store
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries # Questions kept per group #
+        self.hits = 0
+        self.misses = 0
+
+    def group_key(self, doc_hash, model_id, inference_params): # inference_params is a dict of everything that changes the answer #
+        return content_hash("answers", doc_hash, model_id, repr(sorted(inference_params.items())))
+
+    def lookup(self, group, vector): # Return the best entry at or above the threshold, or None #
+        entries = self._live(self.store.get(group, []))
+        best, best_similarity = None, self.threshold
+        if entries:
+            query = _unit(vector)
+            similarities = np.stack([entry['vector'] for entry in entries]) @ query
+            index = int(np.argmax(similarities))
+            if similarities[index] >= best_similarity:
+                best, best_similarity = entries[index], float(similarities[index])
+        if best is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return dict(best, similarity=best_similarity)
+
+    def add(self, group, vector, question, answer, context): # Store an answer with the context it was generated from #
+        entries = self._live(self.store.get(group, []))
+        entries.append({'vector': _unit(vector), 'question': question, 'answer': answer, 'context': context, 'created': time.time()})
+        self.store.set(group, entries[-self.max_entries:])
+
+    def _live(self, entries): # Drop expired entries #
+        cutoff = time.time() - self.ttl
+        return [entry for entry in entries if entry['created'] >= cutoff]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0}
+
+
+#_unit function to normalize a vector for cosine similarity
+def _unit(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+'''_________________________________________________________________________________________________________________'''
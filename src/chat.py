@@ -49,3 +49,16 @@ def chatbot(query,response):
     st.session_state['pastinp'].append(query)
     st.session_state['pastresp'].append(response)
     render_chat()
+
+# Function for rendering a streamed response while it is generated
+# The text is shown in a placeholder as the deltas arrive, the placeholder is cleared at the end
+# so that chatbot() can add the full response to the chat history
+# Returns the full response
+def stream_response(deltas):
+    placeholder=st.empty()
+    response=""
+    for delta in deltas:
+        response+=delta
+        placeholder.markdown(response+"▌")
+    placeholder.empty()
+    return response
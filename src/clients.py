@@ -0,0 +1,62 @@
+''' clients.py contains the registry of AWS clients shared by all modules and sessions of RAG_Chatbot'''
+''' One client per (service, region) is created with pooled, kept-alive connections, timeouts and adaptive retries'''
+''' Run "python src/clients.py [calls]" to measure the per-call overhead removed by reusing clients'''
+
+import sys # Import sys to read the benchmark arguments
+import time # Import time for the benchmark
+import threading # Import threading to create each client once
+import boto3 # Import boto3 to create AWS clients
+from botocore.config import Config # Import Config for connection pool, keep-alive, timeout and retry options
+from configparser import ConfigParser # Import ConfigParser library for reading the client settings
+
+config_object = ConfigParser()
+config_object.read("config.ini")
+client_config = Config(
+    max_pool_connections=config_object.getint("CLIENTS","max_pool_connections",fallback=50), # Concurrent requests per client
+    tcp_keepalive=True,
+    connect_timeout=config_object.getint("CLIENTS","connect_timeout",fallback=5),
+    read_timeout=config_object.getint("CLIENTS","read_timeout",fallback=300), # Long generations stream for minutes
+    retries={'mode': 'adaptive', 'max_attempts': config_object.getint("CLIENTS","max_attempts",fallback=4)},
+)
+bedrock_config = client_config.merge(Config(retries={'mode': 'adaptive', 'total_max_attempts': 1})) # Model calls are retried by resilience.py #
+'''_________________________________________________________________________________________________________________'''
+
+
+_session = boto3.session.Session() # Credentials are resolved once for all clients #
+_clients = {}
+_clients_lock = threading.Lock()
+
+#get_client function to return the shared client of an AWS service in a region
+#boto3 clients are thread safe once created, creation itself is guarded by a lock
+#parameters: "service" e.g. bedrock-runtime, textract, s3, transcribe, "region" defaults to the configured AWS region
+def get_client(service, region=None):
+    key = (service, region)
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                config = bedrock_config if service == 'bedrock-runtime' else client_config
+                client = _clients[key] = _session.client(service_name=service, region_name=region, config=config)
+    return client
+'''_________________________________________________________________________________________________________________'''
+
+
+#benchmark function to compare creating a bedrock-runtime client per call (as the app used to) with the shared registry
+#no request is sent, so it measures only client creation, credential resolution and endpoint setup
+def benchmark(calls=50, region="us-east-1"):
+    start = time.time()
+    for _ in range(calls):
+        boto3.client(service_name='bedrock-runtime', region_name=region)
+    per_call_new = (time.time() - start) / calls * 1000
+    get_client('bedrock-runtime', region) # Created once #
+    start = time.time()
+    for _ in range(calls):
+        get_client('bedrock-runtime', region)
+    per_call_shared = (time.time() - start) / calls * 1000
+    print(f"new client per call: {per_call_new:.2f}ms, shared client: {per_call_shared:.4f}ms, saved per call: {per_call_new - per_call_shared:.2f}ms")
+    print("Reused clients also keep their TLS connections open, which saves a handshake on every Bedrock request")
+
+
+if __name__ == "__main__":
+    benchmark(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,154 @@
+''' embeddings.py contains the Amazon Bedrock embedding layer used to index documents'''
+''' Chunk vectors are cached on disk by (model id, chunk hash), only the misses are sent to Bedrock, concurrently and with retry on throttling'''
+
+import json # Import json to build the Bedrock request bodies
+import asyncio # Import asyncio for the async LangChain interface
+import time # Import time to measure embedding latency
+import threading # Import threading to guard the query embedding cache
+from collections import OrderedDict # Import OrderedDict for the query embedding LRU cache
+import numpy as np # Import numpy to return the vectors as one contiguous array
+from langchain_core.embeddings import Embeddings # Import Embeddings so FAISS can use this layer directly
+from configparser import ConfigParser # Import ConfigParser library for reading the embedding settings
+from cache import get_cache, content_hash # Import the persistent cache shared by all sessions
+from clients import get_client # Import the shared, pooled AWS clients
+from resilience import resilient_call # Import the retry and deadline layer around Bedrock calls
+from admission import request_class, estimate_tokens # Import the request class used by the admission control
+from async_bedrock import submit, acall, agather, gather # Import the event loop that fans out the embedding calls, bounded by [EMBEDDINGS] max_concurrency
+
+config_object = ConfigParser()
+config_object.read("config.ini")
+query_cache_size=config_object.getint("EMBEDDINGS","query_cache_size",fallback=4096) # Question vectors kept in memory per process
+cohere_batch_size=96 # Cohere embed accepts up to 96 texts per request
+
+embedding_cache=get_cache("embeddings", default_max_mb=1024)
+'''_________________________________________________________________________________________________________________'''
+
+
+
+# QueryEmbeddingCache is a bounded in-memory LRU of question vectors, shared by all sessions of the process #
+# Questions are normalized (case, whitespace, trailing punctuation) so trivially different questions share a vector #
+# It counts the embedding calls it saved and estimates the milliseconds saved from the average latency of the misses #
+class QueryEmbeddingCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.miss_ms = 0.0 # Total latency of the embedding calls made on misses #
+        self._vectors = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_embed(self, model_id, text, embed): # Return (vector, cached, ms) for a question, calling embed(text) on a miss #
+        key = (model_id, normalize_query(text))
+        with self._lock:
+            vector = self._vectors.get(key)
+            if vector is not None:
+                self._vectors.move_to_end(key)
+                self.hits += 1
+                return vector, True, 0.0
+        start = time.time()
+        vector = embed(text)
+        ms = (time.time() - start) * 1000
+        with self._lock:
+            self.misses += 1
+            self.miss_ms += ms
+            self._vectors[key] = vector
+            self._vectors.move_to_end(key)
+            while len(self._vectors) > self.max_entries:
+                self._vectors.popitem(last=False)
+        return vector, False, ms
+
+    def stats(self):
+        with self._lock:
+            avg_miss_ms = self.miss_ms / self.misses if self.misses else 0.0
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'entries': len(self._vectors), 'calls_saved': self.hits, 'ms_saved': round(self.hits * avg_miss_ms, 1),
+                    'avg_miss_ms': round(avg_miss_ms, 1)}
+
+
+#normalize_query function to map trivially different questions to the same cache key
+def normalize_query(text):
+    return " ".join(text.split()).casefold().rstrip("?.! ")
+
+
+query_embedding_cache = QueryEmbeddingCache(query_cache_size)
+'''_________________________________________________________________________________________________________________'''
+
+
+# CachedBedrockEmbeddings is a LangChain Embeddings implementation on top of Amazon Bedrock #
+# embed_array is the main entry point and returns a float32 array of shape (len(texts), dim) #
+# embed_documents/embed_query keep the LangChain interface used by FAISS, questions go through the query embedding cache #
+class CachedBedrockEmbeddings(Embeddings):
+    def __init__(self, model_id, region_name):
+        self.model_id = model_id
+        self.region_name = region_name
+        self.client = get_client('bedrock-runtime', region_name)
+
+    def embed_array(self, texts): # Embed texts, reading cached chunk vectors and embedding only the misses #
+        keys, cached, missing = self._lookup(texts)
+        if missing:
+            cached.update(self._store(missing, self._embed_missing([text for _, text in missing])))
+        return self._stack(keys, cached)
+
+    def embed_documents(self, texts):
+        return self.embed_array(texts).tolist()
+
+    async def aembed_documents(self, texts): # Async LangChain interface, the misses are fanned out on the event loop of async_bedrock.py #
+        loop = asyncio.get_running_loop()
+        keys, cached, missing = await loop.run_in_executor(None, self._lookup, texts)
+        if missing: # Each batch takes its own "embed" slot, no slot is held while waiting for them #
+            batches = await asyncio.wrap_future(submit(agather("embed", [(self._embed_batch, (batch,)) for batch in self._batches([text for _, text in missing])])))
+            vectors = [vector for batch_vectors in batches for vector in batch_vectors]
+            cached.update(await loop.run_in_executor(None, self._store, missing, vectors))
+        return self._stack(keys, cached).tolist()
+
+    async def aembed_query(self, text):
+        return await asyncio.wrap_future(submit(acall("embed", self.embed_query, text)))
+
+    def embed_query(self, text): # Questions are cached in memory only, see QueryEmbeddingCache #
+        vector, cached, ms = query_embedding_cache.get_or_embed(self.model_id, text, lambda t: self._embed_batch([t], input_type="search_query")[0])
+        stats = query_embedding_cache.stats()
+        print(f"Query embedding {'cache hit' if cached else f'call {ms:.0f}ms'}: {stats['calls_saved']} calls and {stats['ms_saved']}ms saved so far")
+        return vector.tolist()
+
+    def _lookup(self, texts): # Return (keys, cached vectors, [(key, text)] of the misses), duplicate chunks are embedded once #
+        keys = [content_hash("embedding", self.model_id, text) for text in texts]
+        cached = embedding_cache.get_many(set(keys))
+        missing = list({key: text for key, text in zip(keys, texts) if key not in cached}.items())
+        return keys, cached, missing
+
+    def _store(self, missing, vectors): # Cache the vectors of the misses and return them by key #
+        fresh = {key: vector for (key, _), vector in zip(missing, vectors)}
+        embedding_cache.set_many(fresh)
+        return fresh
+
+    def _stack(self, keys, cached):
+        if not keys:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.ascontiguousarray(np.stack([cached[key] for key in keys]), dtype=np.float32)
+
+    def _batches(self, texts):
+        if 'cohere' in self.model_id:
+            return [texts[i:i + cohere_batch_size] for i in range(0, len(texts), cohere_batch_size)]
+        return [[text] for text in texts] # Titan embeds one text per request #
+
+    def _embed_missing(self, texts): # Fan the misses out on the event loop, keeping input order #
+        vectors = []
+        for batch_vectors in gather("embed", [(self._embed_batch, (batch,)) for batch in self._batches(texts)]):
+            vectors.extend(batch_vectors)
+        return vectors
+
+    def _embed_batch(self, texts, input_type="search_document"): # One Bedrock request, retried while throttled (see resilience.py) #
+        if 'cohere' in self.model_id:
+            body = json.dumps({"texts": texts, "input_type": input_type})
+        else:
+            body = json.dumps({"inputText": texts[0]})
+        def call(model_id):
+            response = self.client.invoke_model(body=body, modelId=model_id, accept="application/json", contentType="application/json")
+            return json.loads(response['body'].read())
+        with request_class(interactive=input_type == "search_query", tokens=sum(estimate_tokens(text) for text in texts)): # Questions go ahead of documents #
+            response_body, _ = resilient_call(call, self.model_id, use_fallbacks=False) # Vectors of another model would not match the index #
+        if 'cohere' in self.model_id:
+            return [np.asarray(v, dtype=np.float32) for v in response_body['embeddings']]
+        return [np.asarray(response_body['embedding'], dtype=np.float32)]
+'''_________________________________________________________________________________________________________________'''
@@ -17,18 +17,25 @@ import streamlit as st # Import Streamlit library
 from configparser import ConfigParser # Import ConfigParser library for reading config file to get model, greeting message, etc.
 from PIL import Image # Import Image library for loading images
 import os # Import os library for environment variables
+import pathlib # Import pathlib to check the extension of the uploaded file
+from contextlib import nullcontext # Import nullcontext as the lock of databases that are not being built in the background
 from utils import * # Import utility functions
-from loaders import create_embeddings, check_upload # Import functions to load input from different sources
-from textgeneration import generate_response, search_context, summary, generate_insights, generate_questions # Import functions to generate text from input
-from chat import initialize_chat, render_chat, chatbot 
+from loaders import create_embeddings, check_upload, streaming_ingestion, stream_pdf, get_ingestion, ingestion_status # Import functions to load input from different sources
+from cache import content_hash # Import content_hash to key cached answers by document
+from textgeneration import answer_question, search_context, summary, generate_insights, generate_questions, precompute_summaries, get_precompute, cancel_precompute # Import functions to generate text from input
+from chat import initialize_chat, render_chat, chatbot, stream_response 
+from admission import set_session # Import set_session to queue this session's Bedrock calls fairly with other sessions
+from streamlit.runtime.scriptrunner import get_script_run_ctx # Import get_script_run_ctx to get the session id
 
 Page_name = st.session_state["page_name"] = "Home"
+set_session(getattr(get_script_run_ctx(),"session_id",None)) # Bedrock calls of this run (and the work they fan out) belong to this session
 # Create config object and read the config file #
 config_object = ConfigParser()
 config_object.read("config.ini")
 
 # Initialize variables and reading configuration #
 greeting=config_object["MSG"]["greeting"] # initial chat message
+stream_answers=config_object.getboolean("STREAMING","enabled",fallback=True) # render answers while they are generated
 hline=Image.open(config_object["IMAGES"]["hline"]) # image for formatting landing screen
 uploaded=None # initialize input document to None
 
@@ -68,23 +75,45 @@ st.sidebar.image(hline) # Add horizontal line
 # If input mode has been chosen and link/doc provided, convert the input to text #
 if uploaded is not None and uploaded !="":
 
+    # Large pdfs are streamed: pages are extracted, chunked, embedded and indexed in the background #
+    streaming=streaming_ingestion and input_choice=="Document" and pathlib.Path(uploaded.name).suffix.lower()==".pdf" and stream_pdf(uploaded)
+    ingest_done=True # Inputs that are not streamed are fully processed before the tabs are shown
+    db_lock=nullcontext()
     with st.spinner("reading "+input_choice+"..." if input_choice!="YouTube" else "extracting audio from YouTube..." if input_choice=="YouTube" else "extracting text from image..."): # Wait while input is being read
-        words, pages, string_data,succeed,token=check_upload(uploaded=uploaded,input_choice=input_choice,params=params) 
-        # Get input text from input document
-        # words - number of words in the input
-        # pages - number of embeddings in the input
-        # string_data - input text
-        # succeed - boolean variable to check if input document was read successfully
-        # token - number of tokens in the input
-        if token>2500: # If input is large, create embeddings for the document
-            #db,pages=create_embeddings(string_data) 
-            db,pages=create_embeddings(string_data,params) 
+        if streaming:
+            ingest=get_ingestion(uploaded,params) # Start (or pick up) the background ingestion of this file
+            words, pages, string_data,succeed,token=ingestion_status(ingest)
+            ingest_done=ingest['done']
+            db, db_lock=ingest['db'], ingest['lock']
+            if 'index_update' in ingest: # A new version of the pdf was re-indexed incrementally #
+                st.session_state['index_update']=ingest.pop('index_update')
+            use_db=db is not None and (not ingest_done or token>2500) # Answer from the chunks indexed so far until the whole document is known
+        else:
+            words, pages, string_data,succeed,token=check_upload(uploaded=uploaded,input_choice=input_choice,params=params) 
+            # Get input text from input document
+            # words - number of words in the input
+            # pages - number of embeddings in the input
+            # string_data - input text
+            # succeed - boolean variable to check if input document was read successfully
+            # token - number of tokens in the input
+            use_db=token>2500
+            if token>2500: # If input is large, create embeddings for the document
+                #db,pages=create_embeddings(string_data) 
+                db,pages=create_embeddings(string_data,params,source=getattr(uploaded,"name",uploaded)) 
 
     # Show input summary #
     col1, col2, col3=st.sidebar.columns(3) # Create columns
     col1.markdown("# :violet[#Tokens:] :blue["+str(token)+"]") # Show number of tokens in the input
     col2.write("# :violet[#Words:] :blue["+str(words)+"]") # Show number of words in the input
     col3.markdown("# :violet[#Embeddings:] :blue["+str(pages)+"]") # Show number of embeddings in the input
+    if 'index_update' in st.session_state: # A new version of a document was re-indexed incrementally #
+        report=st.session_state.pop('index_update')
+        st.sidebar.caption("Re-indexed: "+str(report['reused'])+" chunks reused, "+str(report['added'])+" embedded, "+str(report['removed'])+" removed"+(", index rebuilt" if report['rebuilt'] else "")+". About "+str(report['seconds_saved'])+"s of embedding saved.")
+    if precompute_summaries and succeed and ingest_done: # Prepare the Document Summary tab in the background #
+        precompute=get_precompute(string_data,params,token)
+    if not ingest_done: # Show progress of the background ingestion #
+        st.sidebar.info("Processing document: "+str(len(ingest['page_texts']))+" pages read, "+str(pages)+" chunks indexed. Questions are answered from the indexed part.")
+        st.sidebar.button("Refresh progress",use_container_width=True)
 
 
     # Splitting app into tabs #
@@ -105,15 +134,25 @@ if uploaded is not None and uploaded !="":
                 with st.container(): # Define container for the chat
                     render_chat() # Function renders chat messages based on recorded chat history
             if submitted:
-                if token>2500:
-                    with st.spinner("Finding most relevant section of the document..."):
-                        info=search_context(db,inp)
-                    with st.spinner("Preparing response..."):
-                        final_text=generate_response(inp,info,params)
+                if not ingest_done and db is None: # Nothing indexed yet #
+                    st.info("The first pages of the document are still being indexed. Please submit your question again in a moment.")
+                    final_text=None
                 else:
-                    info=string_data
-                    with st.spinner("Scanning document for response..."): # Wait while Bedrock response is awaited #
-                        final_text=generate_response(inp,info,params) # Gets response to user question. In case the question is out of context, gets general response calling out 'out of context' #
+                    stream_metrics={} # time to first token and tokens per second of a streamed answer
+                    doc_hash=content_hash(string_data) if ingest_done else None # Answers from a partially indexed document are not cached
+                    if use_db:
+                        def find_context(): # Only called when the answer is not cached
+                            with st.spinner("Finding most relevant section of the document..."):
+                                with db_lock: # The index may be growing in the background
+                                    return search_context(db,inp,params)
+                        with st.spinner("Preparing response..."):
+                            final_text,cache_hit=answer_question(inp,params,doc_hash,find_context,stream_answers,stream_metrics)
+                    else:
+                        info=string_data
+                        with st.spinner("Scanning document for response..."): # Wait while Bedrock response is awaited #
+                            final_text,cache_hit=answer_question(inp,params,doc_hash,lambda: info,stream_answers,stream_metrics,static_context=True) # Gets response to user question. In case the question is out of context, gets general response calling out 'out of context' #
+                    if cache_hit is not None:
+                        st.caption("Answered from cache - a similar question was asked before: \""+cache_hit['question']+"\"")
                 
                     # This section creates columns for two buttons, to clear chat and to download the chat as history #
                 col1,col2,col3,col4=st.columns(4)
@@ -122,37 +161,50 @@ if uploaded is not None and uploaded !="":
                 col4.download_button("Download History",data=f,file_name='history.txt')
 
                 with st.container():
+                    if final_text is not None:
+                        if not isinstance(final_text,str): # Streamed answer, rendered as it is generated #
+                            final_text=stream_response(final_text)
+                            if stream_metrics.get('ttft_ms') is not None: # Filled once the stream has ended #
+                                speed=f" at {stream_metrics['tokens_per_sec']} tokens/s" if stream_metrics.get('tokens_per_sec') is not None else "" # No rate for empty or single-chunk streams #
+                                st.caption(f"First token after {stream_metrics['ttft_ms']} ms, {stream_metrics.get('tokens',0)} tokens{speed}")
                         chatbot(inp,final_text) # adds the latest question and response to the session messages and renders the chat #
+                    else:
+                        render_chat()
 
     with tab2: # Document Summary Tab #
 
         info=string_data # pass the entire text for summarization
-        with st.form('tab2',clear_on_submit=False):
-            choice=st.radio("Select the type of summary you want to see",("Summary","Key Points","Sample Questions","Extracted Text"),key="tab2",horizontal=True)
-            submitted=st.form_submit_button("Submit")
-            if submitted:
-                if choice=="Summary":
-                    st.markdown("# Summary")
-                    start = time.time()
-                    st.write(summary(info,params,token))
-                    end = time.time()
-                    seconds = int(((end - start) % 60))
-                    minutes = int((end - start) // 60)
-                    total_time = f"""Time taken to generate a summary:
+        if not ingest_done: # Summaries need the whole document #
+            st.info("The document is still being processed. Summary, key points and sample questions will be available once all pages are read.")
+        else:
+            if precompute_summaries and succeed and not precompute['done']:
+                st.caption("Preparing summary, key points and sample questions in the background: "+str(precompute['chunks_done'])+" of "+str(precompute['chunks'] or "?")+" sections summarized.")
+            with st.form('tab2',clear_on_submit=False):
+                choice=st.radio("Select the type of summary you want to see",("Summary","Key Points","Sample Questions","Extracted Text"),key="tab2",horizontal=True)
+                submitted=st.form_submit_button("Submit")
+                if submitted:
+                    if choice=="Summary":
+                        st.markdown("# Summary")
+                        start = time.time()
+                        st.write(summary(info,params,token))
+                        end = time.time()
+                        seconds = int(((end - start) % 60))
+                        minutes = int((end - start) // 60)
+                        total_time = f"""Time taken to generate a summary:
                     Minutes: {minutes} Seconds: {round(seconds, 2)}"""
-                    with st.sidebar:
-                        st.header(total_time)
-                elif choice=="Key Points":
-                    st.markdown("# Key Points")
-                    st.write(generate_insights(info,params,token))
-                elif choice=="Sample Questions":
-                    st.markdown("# Sample Questions")
-                    st.write(generate_questions(info,params,token))
-                elif choice=="Extracted Text":
-                    st.markdown("# Extracted Text")
-                    st.write(info)
-            else:
-                st.markdown("Note: :red[The app may go back to the QnA tab after Submit is clicked. Please click on the Document Summary tab again to see the response.]")
+                        with st.sidebar:
+                            st.header(total_time)
+                    elif choice=="Key Points":
+                        st.markdown("# Key Points")
+                        st.write(generate_insights(info,params,token))
+                    elif choice=="Sample Questions":
+                        st.markdown("# Sample Questions")
+                        st.write(generate_questions(info,params,token))
+                    elif choice=="Extracted Text":
+                        st.markdown("# Extracted Text")
+                        st.write(info)
+                else:
+                    st.markdown("Note: :red[The app may go back to the QnA tab after Submit is clicked. Please click on the Document Summary tab again to see the response.]")
                 
 
     with tab3:  # About Tab #
@@ -171,6 +223,7 @@ if uploaded is not None and uploaded !="":
              third_column()
         st.image(hline)
 else: # Default Main Page without Chat #
+    cancel_precompute() # The document was removed #
     st.image(hline)
     heads()
     st.image(hline)
@@ -0,0 +1,60 @@
+''' index_store.py persists FAISS vector stores on local disk, keyed by document content hash and embedding model id'''
+''' A restarted process or a second replica opens an existing index from disk and makes no embedding calls'''
+
+import os # Import os to manage the index directories
+import pickle # Import pickle to store the docstore next to the index
+import shutil # Import shutil to remove a temporary index directory
+import tempfile # Import tempfile to write an index atomically
+import faiss # Import faiss to write and memory-map raw indexes
+from langchain_community.vectorstores import FAISS # Import FAISS to rebuild the LangChain vector store
+from configparser import ConfigParser # Import ConfigParser library for reading the index store settings
+from cache import content_hash # Import content_hash to build the index key
+from vector_index import enable_reconstruct # Import enable_reconstruct so that MMR works on IVF indexes stored without a direct map
+
+config_object = ConfigParser()
+config_object.read("config.ini")
+index_dir=config_object.get("INDEX","index_dir",fallback="./cache/indexes") # Directory holding one sub directory per index
+'''_________________________________________________________________________________________________________________'''
+
+
+#index_key function to build the key of an index
+#parameters: "doc_hash" is the content hash of the document (and chunking), "model_id" is the embedding model id
+#returns: key used as the directory name of the index
+def index_key(doc_hash, model_id):
+    return content_hash("faiss", doc_hash, model_id)
+
+
+#save_index function to write a vector store under its key
+#the raw faiss index and the docstore are written to a temporary directory that is then renamed to the key,
+#so a reader in another process never sees a half written index
+#keys are content hashes, so when another process stored the same key first its index is kept and this one is dropped
+def save_index(db, key):
+    os.makedirs(index_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=index_dir, prefix=".tmp-")
+    faiss.write_index(db.index, os.path.join(tmp_dir, "index.faiss"))
+    with open(os.path.join(tmp_dir, "index.pkl"), "wb") as f:
+        pickle.dump((db.docstore, db.index_to_docstore_id), f, protocol=pickle.HIGHEST_PROTOCOL)
+    target = os.path.join(index_dir, key)
+    try:
+        os.rename(tmp_dir, target) # Atomic, fails when the target directory already holds an index #
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if not os.path.isfile(os.path.join(target, "index.pkl")):
+            raise
+
+
+#load_index function to open a stored vector store
+#parameters: "key" is the index key, "embeddings" is used for query embeddings only, "mmap" opens the index read-only with memory-mapped reads
+#returns: FAISS vector store or None if the index is not stored
+#Note: faiss (1.7.4) memory-maps only the inverted lists of IVF indexes, Flat and HNSW indexes are read into memory either way
+#Note: mmap indexes are read only, pass mmap=False to get an index that can be added to
+def load_index(key, embeddings, mmap=True):
+    path = os.path.join(index_dir, key)
+    if not os.path.isfile(os.path.join(path, "index.pkl")):
+        return None
+    flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY if mmap else 0
+    index = enable_reconstruct(faiss.read_index(os.path.join(path, "index.faiss"), flags))
+    with open(os.path.join(path, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    return FAISS(embedding_function=embeddings, index=index, docstore=docstore, index_to_docstore_id=index_to_docstore_id)
+'''_________________________________________________________________________________________________________________'''
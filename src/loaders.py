@@ -2,26 +2,32 @@
 '''It also contains functions to create embeddings from text'''
 
 import os # Import os to remove image file from Assets folder
-import boto3 # Import to use Bedrock Emmbedding Model
+import io # Import io to count the pages of an uploaded pdf in memory
 import tempfile # Import tempfile for CSV Data file
 from datetime import datetime
+import threading # Import threading to run the streaming ingestion pipeline in the background
+import contextvars # Import contextvars to keep the session of the ingestion thread
+import multiprocessing # Import multiprocessing to start the pdf workers without forking the server
+from concurrent.futures import ProcessPoolExecutor # Import ProcessPoolExecutor to extract pdf pages in parallel
 
 '''Libraries for Text Data Extraction'''
 
 from langchain_community.document_loaders import TextLoader, YoutubeLoader, AmazonTextractPDFLoader, UnstructuredPowerPointLoader,CSVLoader
 from langchain_community.document_loaders.image import UnstructuredImageLoader # Import UnstructuredImageLoader to extract text from image file
 import pdfplumber # Import pdfplumber to extract text from pdf file
+from pdf_extract import extract_page_range # Import the page extraction run in the pdf worker processes
 import pathlib # Import pathlib to extract file extension
 import requests # Import requests to extract text from weblink
 from bs4 import BeautifulSoup # Import BeautifulSoup to parse response from weblink
 '''Libraries for Embeddings'''
 from langchain.text_splitter import RecursiveCharacterTextSplitter # Import RecursiveCharacterTextSplitter to split text into chunks of 10000 tokens
-from langchain_community.embeddings import BedrockEmbeddings
-from langchain_aws import BedrockEmbeddings
+from embeddings import CachedBedrockEmbeddings # Import the cached, concurrent Bedrock embedding layer
 from langchain_community.vectorstores import FAISS # Import FAISS to create embeddings
+from langchain_core.documents import Document # Import Document to wrap streamed chunks
 '''Libraries for Web App'''
-import tiktoken # Import tiktoken to count number of tokens
+from tokenizer import count_tokens # Import the shared token counter
 import streamlit as st # Import streamlit to create web app
+from streamlit.runtime.scriptrunner import add_script_run_ctx # Import add_script_run_ctx so the ingestion thread can use streamlit caches
 import time
 import pandas as pd
 # For YouTube Module
@@ -29,24 +35,84 @@ from youtube_transcript_api.formatters import JSONFormatter # new added for Yout
 from youtube_transcript_api import YouTubeTranscriptApi # new added for YoutTube - 4/15
 
 from configparser import ConfigParser # Import ConfigParser library for reading config file to get S3 Bucket and Prefix.
+from cache import get_cache, content_hash, single_flight # Import the persistent cache shared by all sessions and the single-flight layer
+from clients import get_client # Import the shared, pooled AWS clients (Transcribe, Textract, S3)
+from index_store import index_key, save_index, load_index # Import the on-disk FAISS index store
+from vector_index import create_vector_store, resize_vector_store, remove_from_vector_store, supports_removal # Import index type selection by corpus size
+from retrieval import lexical_index # Import the BM25 index built next to each FAISS database
 
 config_object = ConfigParser()
 config_object.read("config.ini")
 #bucket=config_object["BUCKET"]["s3_bucket"]
 #bucket_prefix=config_object["PREFIX"]["s3_prefix"] 
 
+# Parallel pdf extraction settings - 0 workers means one worker per CPU core #
+pdf_workers=config_object.getint("EXTRACTION","pdf_workers",fallback=0) or os.cpu_count() or 1
+pdf_parallel_min_pages=config_object.getint("EXTRACTION","pdf_parallel_min_pages",fallback=16)
+
+# Extraction cache settings - bump EXTRACTOR_VERSION whenever an extract_* function changes its output #
+EXTRACTOR_VERSION="1"
+link_cache_ttl=config_object.getint("CACHE","link_ttl_seconds",fallback=86400) # Weblinks can change, so their text expires #
+extraction_cache=get_cache("extraction")
+
+# Incremental re-indexing settings - latest index key of every (source, embedding model) and the embedding latency used when no chunk was embedded #
+index_versions=get_cache("index_versions", default_max_mb=16)
+embed_seconds_per_chunk=config_object.getfloat("INDEX","embed_seconds_per_chunk",fallback=0.3)
+
+# Streaming ingestion settings #
+streaming_ingestion=config_object.getboolean("INGESTION","streaming",fallback=True)
+streaming_min_pages=config_object.getint("INGESTION","streaming_min_pages",fallback=10) # Shorter pdfs are extracted whole and only indexed when they are large (see create_embeddings)
+embed_batch_size=config_object.getint("INGESTION","embed_batch_size",fallback=8)
+
 '''_________________________________________________________________________________________________________________'''
 
 
-transcribe = boto3.client('transcribe')
+transcribe = get_client('transcribe')
 
 
 #check_upload function to check if file has been uploaded
 #uses extract_data, extract_page, extract_YT, extract_audio, extract_image to extract text from uploaded file
 #parameters: "uploaded" is the uploaded file, "input_choice" is the input choice selected by the user
 #returns: words->number of words, pages->number of embeddings, string_data->text extracted, True->to indicate successful upload, tokens->number of tokens from tiktoken
-@st.cache_data # Cache upload to avoid re-upload and re-extraction of files #
+#Results are cached on disk by content hash and extractor version, so a file is extracted once for all users and restarts
+#Concurrent uploads of the same input wait for one extraction (single flight), so Textract and Transcribe run once
 def check_upload(uploaded,input_choice,params): # Function to check if file has been uploaded #
+    key=extraction_key(uploaded,input_choice)
+    result=extraction_cache.get(key)
+    if result is None:
+        result=single_flight.do(key,_extract_and_cache,key,uploaded,input_choice,params)
+    if input_choice=="Image": # input_selector saved the image for the extractor, which is not needed when another call extracted it #
+        loc='./Assets/'+str(uploaded.name)
+        if os.path.exists(loc):
+            os.remove(loc)
+    return result
+
+
+def _extract_and_cache(key,uploaded,input_choice,params): # Extraction run once per key by check_upload #
+    result=extraction_cache.get(key) # A call that finished after the lookup in check_upload may have stored it #
+    if result is None:
+        result=_check_upload(uploaded,input_choice,params)
+        if result[3]: # Only successful extractions are cached #
+            extraction_cache.set(key,result,ttl=link_cache_ttl if input_choice in ("Weblink","YouTube") else None)
+    return result
+
+
+#extraction_key function to build the cache key of an input
+#the key covers the content (or link), the extractor that will be used and the extractor version
+def extraction_key(uploaded,input_choice):
+    extractor=input_choice
+    if input_choice=="Document" and st.session_state.get("page_name")=="RFP":
+        extractor="RFP" # RFP page uploads a list of pdfs #
+    if isinstance(uploaded,str): # Weblink or YouTube link #
+        suffixes=""
+    elif isinstance(uploaded,list):
+        suffixes=",".join(pathlib.Path(f.name).suffix.lower() for f in uploaded)
+    else:
+        suffixes=pathlib.Path(uploaded.name).suffix.lower()
+    return content_hash("check_upload",EXTRACTOR_VERSION,extractor,suffixes,uploaded)
+
+
+def _check_upload(uploaded,input_choice,params): # Uncached extraction, dispatched on the input choice #
     if input_choice=="Document": # If input choice is document, call extract_data function #
         if st.session_state["page_name"] == "RFP":
             words, pages, string_data, tokens=extract_data_new(uploaded) # Extract text from uploaded file #
@@ -119,17 +185,18 @@ def extract_data(feed):
 #returns: words->number of words, num->0 to indicate embeddings, text->text extracted, tokens->number of tokens from tiktoken
 #Note: This function is used within check_upload function
 def extract_data_new(feed): # feed is uploaded_file
-    text = ""
-    pg = []
+    page_texts = []
+    provenance = []
     for f in feed:
         if f.name.endswith('.pdf'):
-            with pdfplumber.open(f) as pdf:
-                pages = pdf.pages
-                pg.append(pages)
-                for p in pages:
-                    text+= p.extract_text()
+            texts, spans = extract_pdf_pages(f) # Extract pages of every pdf in upload order #
+            offset = sum(len(page_text) for page_text in page_texts)
+            provenance.extend((f.name, number, start + offset, end + offset) for number, start, end in spans)
+            page_texts.extend(texts)
+    text = "".join(page_texts) # Join all pages in one step #
+    save_provenance(text, provenance)
     words = len(text.split())
-    tokens = num_tokens_from_string(text,encoding_name="cl100k_base")
+    tokens = count_tokens(text)
     return words, 0, text, tokens # Return number of words, number of embeddings(placeholder), extracted text and number of tokens #
 
 
@@ -143,16 +210,110 @@ def extract_data_new(feed): # feed is uploaded_file
 #returns: words->number of words, num->0 to indicate embeddings, text->text extracted, tokens->number of tokens from tiktoken
 #Note: This function is used within extract_data function
 def extract_data_pdf(feed): # Function to extract text from pdf #
-    text="" # Initialize text variable to store extracted text #
-    with pdfplumber.open(feed) as pdf: # Open pdf file using pdfplumber #
-        pages=pdf.pages # Extract pages from pdf #
-        for p in pages: # Iterate through pages and extract text #
-            text+=p.extract_text()  # Extract text from each page #
+    page_texts, spans = extract_pdf_pages(feed) # Extract text of each page, in parallel for large pdfs #
+    text="".join(page_texts) # Join pages in one step instead of repeated concatenation #
+    save_provenance(text, [(feed.name, number, start, end) for number, start, end in spans]) # create_embeddings records the page of each chunk #
     words=len(text.split()) # Count number of words in the extracted text #
-    tokens=num_tokens_from_string(text,encoding_name="cl100k_base") # Count number of tokens in the extracted text #
+    tokens=count_tokens(text) # Count number of tokens in the extracted text #
     return words, 0, text, tokens # Return number of words, number of embeddings(placeholder), extracted text and number of tokens #
 '''_________________________________________________________________________________________________________________'''
 
+#extract_pdf_pages function to extract the text of every page of a pdf file
+#small pdfs are extracted in-process, large pdfs are split into page ranges and extracted on a process pool
+#parameters: "feed" is the uploaded pdf file (or a path)
+#returns: page_texts->list of page texts in page order, spans->list of (page_number, start, end) offsets of each page in the joined text
+#Note: "".join(page_texts) is identical to the text built page by page with pdfplumber
+def extract_pdf_pages(feed):
+    page_texts = list(iter_pdf_pages(feed)) # Collect all pages in page order #
+    return page_texts, page_spans(page_texts)
+'''_________________________________________________________________________________________________________________'''
+
+
+#iter_pdf_pages generator to yield the text of every page of a pdf file, in page order, as soon as it is extracted
+#pages are cached on disk by content hash, so a pdf is only extracted once
+#parameters: "feed" is the uploaded pdf file (or a path)
+#yields: text of each page
+#Note: This generator is the page source of extract_pdf_pages and of the streaming ingestion pipeline
+def iter_pdf_pages(feed):
+    key = content_hash("pdf_pages", EXTRACTOR_VERSION, pathlib.Path(feed).read_bytes() if isinstance(feed, (str, os.PathLike)) else feed)
+    cached = extraction_cache.get(key)
+    if cached is not None: # Pages of this pdf were extracted before #
+        yield from cached
+        return
+    page_texts = []
+    for page_text in _iter_pdf_pages(feed):
+        page_texts.append(page_text)
+        yield page_text
+    extraction_cache.set(key, page_texts)
+
+
+def _iter_pdf_pages(feed): # Uncached page extraction #
+    if isinstance(feed, (str, os.PathLike)): # Feed is already a file on disk #
+        pdf_path, remove_after = str(feed), False
+    else: # Worker processes open the pdf by path, so spill the upload to a temporary file #
+        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
+            tmp_file.write(feed.getvalue())
+            pdf_path, remove_after = tmp_file.name, True
+    try:
+        with pdfplumber.open(pdf_path) as pdf: # Only read the page count here #
+            num_pages = len(pdf.pages)
+        if num_pages < pdf_parallel_min_pages or pdf_workers < 2: # Not worth the process start-up cost #
+            yield from extract_page_range(pdf_path, 0, num_pages)
+        else:
+            for texts in get_pdf_pool().map(extract_page_range, *zip(*_page_ranges(pdf_path, num_pages))): # map keeps page order #
+                yield from texts
+    finally:
+        if remove_after:
+            os.remove(pdf_path)
+'''_________________________________________________________________________________________________________________'''
+
+
+#get_pdf_pool function to create the process pool used for pdf extraction
+#cached as a resource so that all sessions of the app share one pool
+#workers come from a forkserver (spawned where there is none): forking the multithreaded server could copy locks held by its threads
+#and deadlock the workers. Workers only import pdf_extract, not this module and its clients
+@st.cache_resource
+def get_pdf_pool():
+    start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    context = multiprocessing.get_context(start_method)
+    if start_method == "forkserver":
+        context.set_forkserver_preload(["pdf_extract"])
+    return ProcessPoolExecutor(max_workers=pdf_workers, mp_context=context)
+'''_________________________________________________________________________________________________________________'''
+
+
+#_page_ranges function to split the pages of a pdf into contiguous ranges, a few ranges per worker to balance uneven pages
+#returns: list of (pdf_path, start, stop) tuples in page order
+def _page_ranges(pdf_path, num_pages):
+    size = max(1, -(-num_pages // (pdf_workers * 4))) # Ceiling division #
+    return [(pdf_path, start, min(start + size, num_pages)) for start in range(0, num_pages, size)]
+
+
+#save_provenance function to store which file and page each span of an extracted text came from, keyed by the text
+#parameters: "provenance" is a list of (file name, page_number, start, end) in text order
+def save_provenance(text, provenance):
+    extraction_cache.set(content_hash("page_provenance", EXTRACTOR_VERSION, text), provenance)
+
+
+#_file_page_at function to return the (file name, page_number) of a character offset of an extracted text, see save_provenance
+def _file_page_at(provenance, offset):
+    for name, number, start, end in provenance:
+        if offset < end:
+            return name, number
+    return provenance[-1][:2]
+
+
+#page_spans function to record which page each span of the joined text came from
+#returns: list of (page_number, start, end) with 1-based page numbers and end-exclusive character offsets
+def page_spans(page_texts):
+    spans = []
+    offset = 0
+    for number, page_text in enumerate(page_texts, start=1):
+        spans.append((number, offset, offset + len(page_text)))
+        offset += len(page_text)
+    return spans
+'''_________________________________________________________________________________________________________________'''
+
 #extract_data_ppt function to extract text from uploaded pdf file
 #parameters: "feed" is the uploaded file
 #returns: words->number of words, num->0 to indicate embeddings, text->text extracted, tokens->number of tokens from tiktoken
@@ -168,7 +329,7 @@ def extract_data_ppt(feed): # Function to extract text from pdf #
     for i in docs:
         text+= i.page_content
     words=len(text.split()) # Count number of words in the extracted text #
-    tokens=num_tokens_from_string(text,encoding_name="cl100k_base") # Count number of tokens in the extracted text #
+    tokens=count_tokens(text) # Count number of tokens in the extracted text #
     #words, pages, string_data,succeed,token
     return words, 0, text, tokens # Return number of words, number of embeddings(placeholder), extracted text and number of tokens #
 '''_________________________________________________________________________________________________________________'''
@@ -182,7 +343,7 @@ def extract_data_pdf_new(feed): # Function to extract text from pdf #
             for p in pages: # Iterate through pages and extract text #
                 text+=p.extract_text()  # Extract text from each page #
     words=len(text.split()) # Count number of words in the extracted text #
-    tokens=num_tokens_from_string(text,encoding_name="cl100k_base") # Count number of tokens in the extracted text #
+    tokens=count_tokens(text) # Count number of tokens in the extracted text #
     return words, 0, text, tokens # Return number of words, number of embeddings(placeholder), extracted text and number of tokens #
 '''_________________________________________________________________________________________________________________'''
 
@@ -195,7 +356,7 @@ def extract_data_pdf_new(feed): # Function to extract text from pdf #
 def extract_data_txt(feed): # Function to extract text from txt #
     text=feed.read().decode("utf-8") # Read and decode as 'utf-8' to extract text from txt #
     words=len(text.split()) # Count number of words in the extracted text #
-    tokens=num_tokens_from_string(text,encoding_name="cl100k_base") # Count number of tokens in the extracted text #
+    tokens=count_tokens(text) # Count number of tokens in the extracted text #
     return words, 0, text, tokens # Return number of words, number of embeddings(placeholder), extracted text and number of tokens #
 '''_________________________________________________________________________________________________________________'''
 
@@ -213,7 +374,7 @@ def extract_page(link): # Function to extract text from weblink #
     lines = filter(lambda x: x.strip(), text.splitlines()) # Filter out empty lines #
     website_text = "\n".join(lines) # Join lines to form text #
     words=len(website_text.split()) # Count number of words in the extracted text #
-    tokens=num_tokens_from_string(website_text,encoding_name="cl100k_base") # Count number of tokens in the extracted text #
+    tokens=count_tokens(website_text) # Count number of tokens in the extracted text #
     return words, 0, website_text, tokens # Return number of words, number of embeddings(placeholder), extracted text and number of tokens #
 '''_________________________________________________________________________________________________________________'''
 
@@ -234,7 +395,7 @@ def extract_YT(link): # Function to extract text from YouTube link #
             transcript = doc.page_content
             text = transcript
             words=len(text.split()) # Count number of words in the extracted text #
-            tokens=num_tokens_from_string(text,encoding_name="cl100k_base") # Count number of tokens in the extracted text #        
+            tokens=count_tokens(text) # Count number of tokens in the extracted text #        
             metadata = document[0].metadata
             #for key, value in metadata.items():
             #    print(f"{key}: {value}")
@@ -257,7 +418,7 @@ def extract_YT(link): # Function to extract text from YouTube link #
 def extract_audio(feed,params): # Function to extract text from audio file #
     string_data = upload_audio_file_s3(feed,params)
     words=len(string_data.split()) # Count number of words in the extracted text #
-    tokens=num_tokens_from_string(string_data,encoding_name="cl100k_base") # Count number of tokens in the extracted text #
+    tokens=count_tokens(string_data) # Count number of tokens in the extracted text #
     return words,0,string_data, tokens    # Return number of words, number of embeddings(placeholder), extracted text and number of tokens #
 '''_________________________________________________________________________________________________________________'''
 
@@ -275,11 +436,10 @@ def extract_image(feed,uploaded,params): # Function to extract text from image f
     s3_bucket_name = params['Bucket']
     bucket_prefix = params['Prefix']
     region = params['Region_Name']
-    textract_client = boto3.client("textract", region_name=region)
-    s3 = boto3.resource('s3')
-    object = s3.Object(s3_bucket_name,bucket_prefix+"/"+uploaded.name)
+    textract_client = get_client("textract", region)
+    s3_client = get_client("s3")
     txt_data = uploaded.getvalue()
-    result = object.put(Body=txt_data)
+    result = s3_client.put_object(Body=txt_data, Bucket=s3_bucket_name, Key=bucket_prefix+"/"+uploaded.name)
     res = result.get('ResponseMetadata')
     if res.get('HTTPStatusCode') == 200:
         file_path = "s3://"+s3_bucket_name+"/"+bucket_prefix+"/"+uploaded.name
@@ -287,7 +447,7 @@ def extract_image(feed,uploaded,params): # Function to extract text from image f
         document=loader.load()
         text=str(document[0].page_content)
         words=len(text.split())
-        tokens=num_tokens_from_string(text,encoding_name="cl100k_base")
+        tokens=count_tokens(text)
     else:
         st.write("Pls upload the file")
     
@@ -322,49 +482,314 @@ def extract_csv_data(feed): # Function to extract text from image file #
         text+= document[i].page_content
 
     words=len(text.split()) # Count number of words in the extracted text #
-    tokens=num_tokens_from_string(text,encoding_name="cl100k_base") # Count number of tokens in the extracted text #
+    tokens=count_tokens(text) # Count number of tokens in the extracted text #
     return words, document, text, tokens # Return number of words, number of embeddings(placeholder), extracted text and number of tokens #
 '''_________________________________________________________________________________________________________________'''
 
 #create_embeddings function to create embeddings from text
 #uses Amazon Titan Embedding and FAISS to create embeddings from text
-#parameters: "text" is the text to be embedded
+#parameters: "text" is the text to be embedded, "source" is the file name or link the text came from
 #returns: db->database with embeddings, num_emb->number of embeddings
 #Embeddings are created once per input and only if the input text is greater than 2500 tokens
+#Indexes are stored on disk by document hash and embedding model, so restarts and other replicas reuse them without embedding calls
+#When a new version of the same source is uploaded, the previous version's index is updated, in place for Flat indexes (see update_index)
+#Sessions indexing the same text at the same time wait for one of them to embed it (single flight)
 #@st.cache_data # Cache embeddings to avoid re-embedding #
 #def create_embeddings(text): # Function to create embeddings from text #
-@st.cache_resource
-def create_embeddings(text,params): # Function to create embeddings from text #
+@st.cache_resource(max_entries=16) # Keep the most recently used indexes open in this process #
+def create_embeddings(text,params,source=""): # Function to create embeddings from text #
+    embeddings = bedrock_embeddings(params)
+    key = index_key(content_hash("create_embeddings", "10000/2000", text), params['endpoint-emb']) # Document hash includes the chunking #
+    db = load_index(key, embeddings) # Read-only open of a stored index #
+    if db is not None:
+        lexical_index(db) # Build the BM25 index from the same chunks #
+        return db, db.index.ntotal
+    return single_flight.do(key, _build_index, key, text, params, source, embeddings)
+
+
+def _build_index(key, text, params, source, embeddings): # Index build run once per key by create_embeddings #
+    db = load_index(key, embeddings) # A build that finished after the lookup in create_embeddings may have stored it #
+    if db is not None:
+        lexical_index(db)
+        return db, db.index.ntotal
     with open('temp.txt','w') as f: # Write text to a temporary file #
          f.write(text) # Write text to a temporary file #
          f.close() # Close temporary file #
     loader=TextLoader('temp.txt') # Load temporary file using TextLoader #
     document=loader.load() # Extract text from temporary file #
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=10000, chunk_overlap=2000) # Initialize text splitter to split text into chunks of 10000 tokens #
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=10000, chunk_overlap=2000, add_start_index=True) # Initialize text splitter to split text into chunks of 10000 tokens #
     docs = text_splitter.split_documents(document) # Split document into chunks of 10000 tokens #
+    provenance = extraction_cache.get(content_hash("page_provenance", EXTRACTOR_VERSION, text)) # Pages of an extracted pdf, see save_provenance #
+    for doc in docs:
+        start = doc.metadata.pop("start_index")
+        if provenance: # The file and page the chunk starts on, as iter_chunks records for streamed pdfs #
+            doc.metadata["source"], doc.metadata["page"] = _file_page_at(provenance, start)
     num_emb=len(docs) # Count number of embeddings #
     # Use Amazon Bedrock Embedding Model
-    
-    modelId = params['endpoint-emb']
-    embeddings = BedrockEmbeddings(model_id=modelId,region_name=params['Region_Name'])
-    
-
-    db = FAISS.from_documents(docs, embeddings) # Create embeddings from text #
+    version_key = content_hash("index_version", source, params['endpoint-emb']) # Identifies earlier versions of the same source #
+    previous = index_versions.get(version_key) if source else None
+    prev_db = load_index(previous, embeddings, mmap=False) if previous else None # Writable copy of the previous version #
+    if prev_db is not None:
+        db, report = update_index(prev_db, docs, embeddings) # Only new or changed chunks are embedded #
+        print(f"Re-indexed {source}: {report}")
+        st.session_state['index_update'] = report
+    else: # Flat, HNSW or IVF-PQ depending on the number of chunks #
+        texts = [d.page_content for d in docs]
+        db = create_vector_store(texts, embeddings.embed_array(texts), [d.metadata for d in docs], embeddings) # Create embeddings from text #
+    save_index(db, key) # Store the index for other processes and restarts #
+    if source:
+        index_versions.set(version_key, key)
+    lexical_index(db) # Build the BM25 index from the same chunks #
     return db, num_emb # Return database with embeddings and number of embeddings #
 '''_________________________________________________________________________________________________________________'''
 
 
+#update_index function to turn the index of a previous version of a document into the index of the new version
+#chunks are matched by content hash, only new or changed chunks are embedded. A Flat index removes the vectors of deleted chunks
+#and adds the new ones in place, other index types cannot remove vectors (see supports_removal) and are rebuilt from the cached vectors of all chunks
+#parameters: "db" is the previous version's database (not memory-mapped), "docs" are the chunks of the new version
+#returns: db->updated database, report->dict with reused/added/removed chunk counts, whether the index was rebuilt, elapsed seconds and estimated seconds saved
+def update_index(db, docs, embeddings):
+    start = time.time()
+    existing = {} # chunk hash -> docstore ids of the previous version #
+    for doc_id in db.index_to_docstore_id.values():
+        existing.setdefault(content_hash(db.docstore.search(doc_id).page_content), []).append(doc_id)
+    new_docs = []
+    reused = 0
+    for doc in docs:
+        ids = existing.get(content_hash(doc.page_content))
+        if ids: # Unchanged chunk, keep its vector #
+            ids.pop()
+            reused += 1
+        else:
+            new_docs.append(doc)
+    stale = [doc_id for ids in existing.values() for doc_id in ids] # Chunks that are not in the new version #
+    embed_seconds = 0.0
+    vectors = None
+    if new_docs:
+        embed_start = time.time()
+        vectors = embeddings.embed_array([d.page_content for d in new_docs])
+        embed_seconds = time.time() - embed_start
+    rebuilt = bool(stale or new_docs) and not supports_removal(db.index)
+    if rebuilt: # Every vector is in the embedding cache now #
+        texts = [d.page_content for d in docs]
+        db = create_vector_store(texts, embeddings.embed_array(texts), [d.metadata for d in docs], embeddings)
+    else:
+        if stale:
+            db = remove_from_vector_store(db, stale)
+        if new_docs:
+            db.add_embeddings(list(zip([d.page_content for d in new_docs], vectors)), metadatas=[d.metadata for d in new_docs])
+        db = resize_vector_store(db) # The corpus may have outgrown a Flat index #
+    seconds_per_chunk = embed_seconds / len(new_docs) if new_docs else embed_seconds_per_chunk
+    report = {'reused': reused, 'added': len(new_docs), 'removed': len(stale), 'rebuilt': rebuilt,
+              'seconds': round(time.time() - start, 3), 'seconds_saved': round(reused * seconds_per_chunk, 3)}
+    return db, report
+'''_________________________________________________________________________________________________________________'''
+
+
+#bedrock_embeddings function to create the Amazon Bedrock embedding model selected in the sidebar
+#chunk vectors are cached on disk, so re-ingesting a lightly edited document only embeds the new chunks
+def bedrock_embeddings(params):
+    return CachedBedrockEmbeddings(model_id=params['endpoint-emb'],region_name=params['Region_Name'])
+'''_________________________________________________________________________________________________________________'''
 
-#num_tokens_from_string function to count number of tokens in a text string
-#uses tiktoken to count number of tokens in a text string
-#parameters: "string" is the text string, "encoding_name" is the encoding name to be used by tiktoken
-#returns: num_tokens->number of tokens in the text string
-#This function is used within extract_data, extract_page, extract_YT, extract_audio, extract_image functions
-def num_tokens_from_string(string: str, encoding_name="cl100k_base") -> int: # Function to count number of tokens in a text string #
-    encoding = tiktoken.get_encoding(encoding_name) # Initialize encoding #
-    return len(encoding.encode(string)) # Return number of tokens in the text string #
+
+#Streaming ingestion pipeline: extract -> chunk -> embed -> index as pages arrive
+#Pages flow from iter_pdf_pages through iter_chunks into batched embedding calls and incremental FAISS adds
+#The pipeline runs on a background thread, so questions can be answered against the chunks already indexed
+
+#iter_chunks generator to split a stream of pages into the same 10000/2000 chunks used by create_embeddings
+#only a bounded window of text is kept, every chunk except the last one of the window is emitted as soon as it is complete
+#parameters: "page_texts" is an iterable of page texts, "source" is recorded in the chunk metadata
+#yields: Document chunks with the page number the chunk starts on in the metadata
+def iter_chunks(page_texts, source=""):
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=10000, chunk_overlap=2000) # Same splitter as create_embeddings #
+    window = "" # Text not yet emitted as a complete chunk #
+    window_spans = [] # (page_number, start, end) of the pages inside the window #
+    for number, page_text in enumerate(page_texts, start=1):
+        window_spans.append((number, len(window), len(window) + len(page_text)))
+        window += page_text
+        if len(window) < 3 * 10000: # Wait for a few chunks worth of text #
+            continue
+        chunks = text_splitter.split_text(window)
+        cursor = 0
+        for chunk in chunks[:-1]: # The last chunk may still grow with the next page #
+            cursor = window.find(chunk, cursor)
+            yield Document(page_content=chunk, metadata={"source": source, "page": _page_at(window_spans, cursor)})
+        carry = window.find(chunks[-1], cursor) # Keep the last chunk as the start of the next window #
+        window = window[carry:]
+        window_spans = [(n, max(start - carry, 0), end - carry) for n, start, end in window_spans if end > carry]
+    if window:
+        cursor = 0
+        for chunk in text_splitter.split_text(window):
+            cursor = window.find(chunk, cursor)
+            yield Document(page_content=chunk, metadata={"source": source, "page": _page_at(window_spans, cursor)})
+
+
+#_page_at function to look up the page number of a character offset from a list of page spans
+def _page_at(spans, offset):
+    for number, start, end in spans:
+        if offset < end:
+            return number
+    return spans[-1][0] if spans else 1
 '''_________________________________________________________________________________________________________________'''
 
+
+#iter_index_batches generator to embed chunks in batches and add them to one FAISS index incrementally
+#parameters: "chunks" is an iterable of Document chunks, "params" holds the embedding model and region, "lock" guards the index against concurrent searches
+#yields: db->database with the chunks indexed so far, num_emb->number of chunks indexed so far
+def iter_index_batches(chunks, params, lock):
+    embeddings = bedrock_embeddings(params)
+    db = None
+    num_emb = 0
+    batch = []
+    for chunk in chunks:
+        batch.append(chunk)
+        if len(batch) == embed_batch_size:
+            db = _index_batch(db, batch, embeddings, lock)
+            num_emb += len(batch)
+            batch = []
+            yield db, num_emb
+    if batch:
+        db = _index_batch(db, batch, embeddings, lock)
+        num_emb += len(batch)
+        yield db, num_emb
+
+
+#_index_batch function to embed one batch of chunks and add it to the index (the index is created by the first batch)
+def _index_batch(db, batch, embeddings, lock):
+    texts = [d.page_content for d in batch]
+    vectors = embeddings.embed_documents(texts) # Embed outside the lock so searches are not blocked by Bedrock calls #
+    metadatas = [d.metadata for d in batch]
+    if db is None:
+        return FAISS.from_embeddings(list(zip(texts, vectors)), embeddings, metadatas=metadatas)
+    with lock:
+        db.add_embeddings(list(zip(texts, vectors)), metadatas=metadatas)
+    return db
+'''_________________________________________________________________________________________________________________'''
+
+
+#start_ingestion function to start the streaming ingestion pipeline for an uploaded pdf on a background thread
+#parameters: "feed" is the uploaded pdf file, "params" holds the embedding model and region
+#returns: ingest->dict shared with the thread holding db, lock, progress counters, the extracted pages, done/error flags and the cancel event
+def start_ingestion(feed, params):
+    ingest = {
+        'db': None, 'num_emb': 0, 'page_texts': [], 'words': 0, 'tokens': 0,
+        'done': False, 'error': None, 'lock': threading.Lock(), 'cancel': threading.Event(),
+    }
+    thread = threading.Thread(target=contextvars.copy_context().run, args=(_run_ingestion, ingest, feed, params), daemon=True) # Keeps the session for admission #
+    add_script_run_ctx(thread) # Let the thread use the shared pdf pool #
+    thread.start()
+    return ingest
+
+
+#_run_ingestion function is the body of the ingestion thread
+def _run_ingestion(ingest, feed, params):
+    try:
+        pages = _record_pages(ingest, iter_pdf_pages(feed))
+        key = index_key(content_hash("iter_chunks", "10000/2000", feed), params['endpoint-emb'])
+        db = load_index(key, bedrock_embeddings(params))
+        if db is None: # Another session streaming the same file is waited for rather than embedded twice (single flight) #
+            db = single_flight.do(key, _stream_index, ingest, pages, key, params, feed.name)
+            if ingest['cancel'].is_set(): # A different file was uploaded #
+                return
+        if db is not None and ingest['db'] is not db: # Indexed before or by another session, only the pages are needed #
+            ingest['db'], ingest['num_emb'] = db, db.index.ntotal
+            for _ in pages:
+                pass
+        text = "".join(ingest['page_texts'])
+        ingest['words'] = len(text.split())
+        ingest['tokens'] = count_tokens(text) # Count for the whole document, sampled for very large ones #
+    except Exception as e:
+        print(f"Streaming ingestion of {feed.name} failed: {e}")
+        ingest['error'] = e
+    finally:
+        ingest['done'] = True
+
+
+#_stream_index function to index the pages of an ingestion as they are extracted, run once per key by _run_ingestion
+#a new version of a source indexed before is not streamed: its chunks are matched against the previous version's index (see update_index)
+#and the reused/added/removed report is left in ingest['index_update']
+#returns: the stored database, or None if the ingestion was cancelled or the document has no text
+def _stream_index(ingest, pages, key, params, source):
+    embeddings = bedrock_embeddings(params)
+    db = load_index(key, embeddings) # An ingestion that finished after the lookup in _run_ingestion may have stored it #
+    if db is not None:
+        return db
+    version_key = content_hash("index_version", source, params['endpoint-emb']) # Same versions as create_embeddings #
+    previous = index_versions.get(version_key)
+    prev_db = load_index(previous, embeddings, mmap=False) if previous else None # Writable copy of the previous version #
+    if prev_db is not None:
+        docs = list(iter_chunks(pages, source=source))
+        if ingest['cancel'].is_set() or not docs:
+            return None
+        db, report = update_index(prev_db, docs, embeddings) # Only new or changed chunks are embedded #
+        print(f"Re-indexed {source}: {report}")
+        ingest['index_update'] = report
+        with ingest['lock']:
+            ingest['db'], ingest['num_emb'] = db, db.index.ntotal
+    else:
+        for db, num_emb in iter_index_batches(iter_chunks(pages, source=source), params, ingest['lock']):
+            ingest['db'], ingest['num_emb'] = db, num_emb
+            if ingest['cancel'].is_set():
+                return None
+        if ingest['db'] is None:
+            return None
+        db = resize_vector_store(ingest['db']) # Streaming builds a Flat index, switch type for large corpora #
+        with ingest['lock']:
+            ingest['db'] = db
+    save_index(db, key)
+    index_versions.set(version_key, key)
+    return db
+
+
+#_record_pages generator to keep the extracted pages (for the summary tab) while they stream into the chunker
+def _record_pages(ingest, page_texts):
+    for page_text in page_texts:
+        if ingest['cancel'].is_set():
+            return
+        ingest['page_texts'].append(page_text)
+        ingest['words'] += len(page_text.split()) # Running counts while the document is being processed #
+        yield page_text
+
+
+#stream_pdf function to decide whether an uploaded pdf goes through the streaming ingestion pipeline
+#pdfs of fewer than streaming_min_pages pages take the check_upload path, which only indexes documents over 2500 tokens
+def stream_pdf(feed):
+    return pdf_page_count(feed.getvalue()) >= streaming_min_pages
+
+
+@st.cache_data(max_entries=64, show_spinner=False) # The page tree is read once per file, not on every rerun #
+def pdf_page_count(data):
+    with pdfplumber.open(io.BytesIO(data)) as pdf:
+        return len(pdf.pages)
+
+
+#get_ingestion function to return the current session's ingestion for an upload, starting it on first sight of the file
+#jobs are keyed by content, a job for a previously uploaded file is cancelled when a different file is uploaded
+def get_ingestion(feed, params):
+    key = (content_hash(feed), params['endpoint-emb'])
+    current = st.session_state.get('ingestion')
+    if current is not None and current['key'] == key:
+        return current
+    if current is not None:
+        current['cancel'].set()
+    ingest = start_ingestion(feed, params)
+    ingest['key'] = key
+    st.session_state['ingestion'] = ingest
+    return ingest
+
+
+#ingestion_status function to report an ingestion in the same shape as check_upload
+#returns: words, pages->number of chunks indexed, string_data->text extracted so far, succeed, tokens
+def ingestion_status(ingest):
+    string_data = "".join(ingest['page_texts'])
+    succeed = ingest['error'] is None
+    return ingest['words'], ingest['num_emb'], string_data, succeed, ingest['tokens']
+'''_________________________________________________________________________________________________________________'''
+
+
+
 # Function call to check the Transcribe Job
 def check_job_name(job_name):
   job_verification = True
@@ -442,7 +867,7 @@ def upload_audio_file_s3(uploaded_file,params): #
             s3_bucket_name = params['Bucket']
             bucket_prefix = params['Prefix']
             #region = params['Region_Name']
-            s3_client = boto3.client("s3")
+            s3_client = get_client("s3")
             response = s3_client.put_object(
                 Body = audio_bytes,
                 Bucket = s3_bucket_name,
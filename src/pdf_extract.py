@@ -0,0 +1,11 @@
+''' pdf_extract.py contains the pdf page extraction run in the worker processes of loaders.py'''
+''' Workers are started from a fresh interpreter, so this module only imports pdfplumber: no config, AWS clients or Streamlit at import time'''
+
+import pdfplumber # Import pdfplumber to extract text from pdf file
+
+
+#extract_page_range function to extract the text of pages [start, stop) of a pdf file
+#runs inside a worker process, so it opens the pdf itself and returns plain strings
+def extract_page_range(pdf_path, start, stop):
+    with pdfplumber.open(pdf_path) as pdf: # Open pdf file using pdfplumber #
+        return [p.extract_text() for p in pdf.pages[start:stop]] # Extract text from each page in the range #
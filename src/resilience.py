@@ -0,0 +1,143 @@
+''' resilience.py wraps every Amazon Bedrock model call of RAG_Chatbot with retries, a deadline, optional hedging and fallback models'''
+''' Throttled or not ready models are retried with exponential backoff and jitter, then the next model of the fallback chain is tried'''
+
+import time # Import time for the backoff and the deadline
+import random # Import random for the backoff jitter
+import threading # Import threading to guard the metrics and create the call pool once
+from collections import Counter # Import Counter for the metrics
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED # Import ThreadPoolExecutor to bound each attempt by the deadline and to hedge
+from botocore.exceptions import ClientError, EndpointConnectionError, ConnectionClosedError, ConnectTimeoutError, ReadTimeoutError # Import the botocore errors that are retried
+from configparser import ConfigParser # Import ConfigParser library for reading the resilience settings
+from admission import admit # Import the admission control that keeps calls within the model quotas
+
+config_object = ConfigParser()
+config_object.read("config.ini")
+max_attempts=config_object.getint("RESILIENCE","max_attempts",fallback=5) # Attempts per model
+base_delay=config_object.getfloat("RESILIENCE","base_delay",fallback=0.5) # First backoff in seconds, doubled on every retry
+max_delay=config_object.getfloat("RESILIENCE","max_delay",fallback=20)
+deadline_seconds=config_object.getfloat("RESILIENCE","deadline_seconds",fallback=180) # Whole request, retries and fallbacks included
+hedge_after_seconds=config_object.getfloat("RESILIENCE","hedge_after_seconds",fallback=0) # Send a second identical request when the first is slower, 0 disables hedging
+max_in_flight=config_object.getint("RESILIENCE","max_in_flight",fallback=64) # Bedrock model calls in flight per process
+# [FALLBACK] holds one chain per option: the first model id is the primary, the next ones are tried in order when it stays throttled #
+# The models of a chain must accept the same request body (same model family) #
+fallback_chains={}
+if config_object.has_section("FALLBACK"):
+    for _, chain in config_object.items("FALLBACK"):
+        models=[model.strip() for model in chain.split(",") if model.strip()]
+        if models:
+            fallback_chains[models[0]]=models[1:]
+
+RETRYABLE_ERRORS = ("ThrottlingException", "TooManyRequestsException", "ServiceUnavailableException", "ModelNotReadyException", "ModelTimeoutException", "InternalServerException")
+# Connection and timeout errors raised by botocore, which does not retry bedrock-runtime calls itself (see bedrock_config in clients.py) #
+CONNECTION_ERRORS = (EndpointConnectionError, ConnectionClosedError, ConnectTimeoutError, ReadTimeoutError)
+'''_________________________________________________________________________________________________________________'''
+
+
+_metrics = Counter() # (model id, metric) -> count #
+_metrics_lock = threading.Lock()
+
+#count function to add to a metric of a model
+def count(model_id, metric, n=1):
+    with _metrics_lock:
+        _metrics[(model_id, metric)] += n
+
+
+#metrics function to return the call metrics of the process per model
+#calls (attempts sent), retries, throttles (retryable errors), connection_errors, hedges, hedge_wins, fallbacks (from this model), deadline_exceeded and failures
+def metrics():
+    with _metrics_lock:
+        snapshot = {}
+        for (model_id, metric), n in _metrics.items():
+            snapshot.setdefault(model_id, {})[metric] = n
+        return snapshot
+'''_________________________________________________________________________________________________________________'''
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+#get_call_pool function to return the thread pool running the attempts, so that a slow attempt can be abandoned at the deadline or hedged
+def get_call_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="bedrock-call")
+        return _pool
+
+
+#resilient_call function to run a Bedrock model call with retries, a deadline, hedging and fallback models
+#parameters: "call" sends the request to the model id it is given and returns the parsed response, "model_id" is the requested model,
+#"use_fallbacks" is False for calls whose result must come from the requested model (e.g. embeddings)
+#returns: (response, model id that served it)
+#raises: the last ClientError when all attempts and fallbacks fail, the last connection error when every attempt failed to connect,
+#TimeoutError when the deadline passes
+def resilient_call(call, model_id, use_fallbacks=True, deadline=deadline_seconds, hedge_after=hedge_after_seconds):
+    end = time.time() + deadline
+    chain = [model_id] + (fallback_chains.get(model_id, []) if use_fallbacks else [])
+    for position, model in enumerate(chain):
+        try:
+            return _call_with_retries(call, model, end, hedge_after), model
+        except ClientError as e:
+            if e.response['Error']['Code'] not in RETRYABLE_ERRORS or position == len(chain) - 1 or time.time() >= end:
+                count(model_id, "failures")
+                raise
+            count(model_id, "fallbacks")
+            print(f"{model} is unavailable ({e.response['Error']['Code']}), falling back to {chain[position + 1]}")
+        except TimeoutError:
+            count(model_id, "deadline_exceeded")
+            count(model_id, "failures")
+            raise
+        except CONNECTION_ERRORS:
+            count(model_id, "failures")
+            raise
+
+
+#_call_with_retries function to call one model until it succeeds, fails with a non retryable error, runs out of attempts or time
+#retryable ClientErrors and connection errors are retried with the same backoff
+def _call_with_retries(call, model, end, hedge_after):
+    for attempt in range(max_attempts):
+        try:
+            return _attempt(call, model, end, hedge_after)
+        except (ClientError,) + CONNECTION_ERRORS as e:
+            if isinstance(e, ClientError):
+                if e.response['Error']['Code'] not in RETRYABLE_ERRORS:
+                    raise
+                count(model, "throttles")
+            else:
+                count(model, "connection_errors")
+            delay = min(max_delay, base_delay * 2 ** attempt) * random.uniform(0.5, 1.0) # Exponential backoff with jitter #
+            if attempt == max_attempts - 1 or time.time() + delay >= end:
+                raise
+            count(model, "retries")
+            time.sleep(delay)
+
+
+#_attempt function to send one request, and a hedged duplicate if it is slower than hedge_after seconds
+#hedged duplicates skip admission, they are only sent for calls that were already admitted
+#returns: the first successful response, raises the last error if every request failed or TimeoutError at the deadline
+def _attempt(call, model, end, hedge_after):
+    admit(model, end) # Every attempt, retries included, counts against the quota #
+    pool = get_call_pool()
+    count(model, "calls")
+    futures = [pool.submit(call, model)]
+    hedge = None
+    if 0 < hedge_after < end - time.time():
+        done, _ = wait(futures, timeout=hedge_after)
+        if not done:
+            count(model, "calls")
+            count(model, "hedges")
+            hedge = pool.submit(call, model)
+            futures.append(hedge)
+    while futures:
+        done, _ = wait(futures, timeout=max(0, end - time.time()), return_when=FIRST_COMPLETED)
+        if not done:
+            raise TimeoutError(f"{model} did not answer before the deadline")
+        for future in done:
+            futures.remove(future)
+            if future.exception() is None:
+                if future is hedge:
+                    count(model, "hedge_wins")
+                return future.result()
+            if not futures: # Every request failed, raise the last error #
+                raise future.exception()
+'''_________________________________________________________________________________________________________________'''
@@ -0,0 +1,208 @@
+''' retrieval.py contains the retrieval stage used to answer questions from large documents'''
+''' Top-k chunks are retrieved (vector, BM25 lexical or both fused with reciprocal rank fusion), filtered by score, '''
+''' merged where the splitter overlap repeats text and packed into a token budget that fits the selected model'''
+
+import re # Import re to tokenize text for BM25
+import math # Import math for the BM25 idf
+import threading # Import threading to guard the lexical index registry
+import weakref # Import weakref to keep one lexical index per open FAISS database
+from collections import Counter # Import Counter for term frequencies
+from tokenizer import encode, decode, count_tokens, DEFAULT_FAMILY # Import the shared tokenizer to count and truncate tokens
+from configparser import ConfigParser # Import ConfigParser library for reading the retrieval settings
+from utils import MODELS_CONTEXT # Import the context window of each LLM
+from async_bedrock import submit, acall # Import the event loop to embed the question while BM25 searches
+
+config_object = ConfigParser()
+config_object.read("config.ini")
+top_k=config_object.getint("RETRIEVAL","k",fallback=6) # Passages kept after retrieval
+fetch_k=config_object.getint("RETRIEVAL","fetch_k",fallback=20) # Candidates fetched for MMR
+max_distance=config_object.getfloat("RETRIEVAL","max_distance",fallback=None) # Score threshold: maximum L2 distance of a passage, unset keeps all
+use_mmr=config_object.getboolean("RETRIEVAL","mmr",fallback=False)
+lambda_mult=config_object.getfloat("RETRIEVAL","lambda_mult",fallback=0.5) # 1 is pure relevance, 0 is pure diversity
+retrieval_mode=config_object.get("RETRIEVAL","mode",fallback="hybrid").lower() # hybrid, vector or lexical (no network calls)
+rrf_k=config_object.getint("RETRIEVAL","rrf_k",fallback=60) # Reciprocal rank fusion constant
+bm25_k1=config_object.getfloat("RETRIEVAL","bm25_k1",fallback=1.2)
+bm25_b=config_object.getfloat("RETRIEVAL","bm25_b",fallback=0.75)
+context_tokens=config_object.getint("RETRIEVAL","context_tokens",fallback=3000) # Upper bound of the packed context
+reserved_tokens=config_object.getint("RETRIEVAL","reserved_tokens",fallback=500) # Prompt instructions and question
+min_overlap=200 # Shortest repeated text treated as splitter overlap
+overlap_window=2500 # The splitter overlap is 2000 characters
+'''_________________________________________________________________________________________________________________'''
+
+
+#retrieve function to fetch the most relevant passages for a question
+#parameters: "db" is the FAISS database, "query" is the question, "k" passages are kept, "mmr" diversifies the vector results,
+#"mode" is hybrid (vector and BM25 fused), vector or lexical (BM25 only, no Bedrock embedding call)
+#returns: list of (page_content, score) ordered by relevance, overlapping chunks merged into one passage
+def retrieve(db, query, k=top_k, mmr=use_mmr, threshold=max_distance, mode=retrieval_mode):
+    rankings = []
+    if mode == "hybrid": # Embed the question on the event loop while BM25 searches #
+        embedding_future = submit(acall("embed", db.embedding_function.embed_query, query))
+        lexical = lexical_index(db)
+        lexical_ranking = [(lexical.texts[doc_id], score) for doc_id, score in lexical.search(query, fetch_k)]
+    if mode in ("hybrid", "vector"):
+        embedding = embedding_future.result() if mode == "hybrid" else db.embedding_function.embed_query(query) # Embed the question once #
+        vector_k = fetch_k if mode == "hybrid" else k
+        if mmr:
+            docs_and_scores = db.max_marginal_relevance_search_with_score_by_vector(embedding, k=vector_k, fetch_k=fetch_k, lambda_mult=lambda_mult)
+        else:
+            docs_and_scores = db.similarity_search_with_score_by_vector(embedding, k=vector_k)
+        if threshold is not None:
+            docs_and_scores = [(doc, score) for doc, score in docs_and_scores if score <= threshold]
+        rankings.append([(doc.page_content, score) for doc, score in docs_and_scores])
+    if mode == "hybrid":
+        rankings.append(lexical_ranking)
+    if mode == "lexical":
+        lexical = lexical_index(db)
+        rankings.append([(lexical.texts[doc_id], score) for doc_id, score in lexical.search(query, k)])
+    if len(rankings) == 1:
+        return dedupe_passages(rankings[0][:k])
+    return dedupe_passages(reciprocal_rank_fusion(rankings)[:k])
+
+
+#reciprocal_rank_fusion function to fuse several rankings of passages
+#each passage scores the sum of 1/(rrf_k + rank) over the rankings it appears in
+#returns: list of (page_content, fused score) with the best first
+def reciprocal_rank_fusion(rankings):
+    fused = {}
+    for ranking in rankings:
+        for rank, (text, _) in enumerate(ranking, start=1):
+            fused[text] = fused.get(text, 0.0) + 1.0 / (rrf_k + rank)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)
+
+
+#dedupe_passages function to drop passages contained in better ones and merge passages that share the splitter overlap
+def dedupe_passages(passages):
+    merged = []
+    for text, score in passages:
+        for i, (kept, kept_score) in enumerate(merged):
+            combined = _merge_overlap(kept, text)
+            if combined is not None:
+                merged[i] = (combined, kept_score)
+                break
+        else:
+            merged.append((text, score))
+    return merged
+
+
+#_merge_overlap function to join two chunks when one contains the other or they overlap at their ends
+#returns: the combined text or None if the chunks do not overlap
+def _merge_overlap(a, b):
+    if b in a:
+        return a
+    if a in b:
+        return b
+    for first, second in ((a, b), (b, a)):
+        tail = first[-overlap_window:]
+        start = tail.find(second[:min_overlap])
+        while start >= 0: # Repeated text can match before the real overlap starts #
+            if second.startswith(tail[start:]):
+                return first + second[len(tail) - start:]
+            start = tail.find(second[:min_overlap], start + 1)
+    return None
+'''_________________________________________________________________________________________________________________'''
+
+
+# BM25Index is an in-memory inverted index with BM25 scoring over the chunks of one FAISS database #
+# Tokens keep part numbers, clause ids and acronyms (e.g. "AB-1234", "4.2.1") whole and also index their parts #
+class BM25Index:
+    def __init__(self):
+        self.postings = {} # term -> {doc id: term frequency} #
+        self.doc_terms = {} # doc id -> Counter of terms, used to remove documents #
+        self.doc_lengths = {} # doc id -> number of terms #
+        self.texts = {} # doc id -> chunk text #
+        self.total_length = 0
+
+    def add(self, doc_id, text):
+        terms = Counter(tokenize(text))
+        self.doc_terms[doc_id] = terms
+        self.texts[doc_id] = text
+        self.doc_lengths[doc_id] = sum(terms.values())
+        self.total_length += self.doc_lengths[doc_id]
+        for term, tf in terms.items():
+            self.postings.setdefault(term, {})[doc_id] = tf
+
+    def remove(self, doc_id):
+        terms = self.doc_terms.pop(doc_id)
+        del self.texts[doc_id]
+        self.total_length -= self.doc_lengths.pop(doc_id)
+        for term in terms:
+            del self.postings[term][doc_id]
+            if not self.postings[term]:
+                del self.postings[term]
+
+    def search(self, query, k): # Return the k best (doc id, score) pairs #
+        num_docs = len(self.doc_terms)
+        if not num_docs:
+            return []
+        avg_length = self.total_length / num_docs
+        scores = {}
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (num_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, tf in postings.items():
+                norm = 1 - bm25_b + bm25_b * self.doc_lengths[doc_id] / avg_length
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (bm25_k1 + 1) / (tf + bm25_k1 * norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+
+#tokenize function to split text into lower case BM25 terms
+def tokenize(text):
+    terms = []
+    for token in re.findall(r"[a-z0-9]+(?:[-_./:][a-z0-9]+)*", text.lower()):
+        terms.append(token)
+        parts = re.split(r"[-_./:]", token)
+        if len(parts) > 1: # Compound identifier, also index its parts #
+            terms.extend(parts)
+    return terms
+
+
+_lexical_indexes = weakref.WeakKeyDictionary()
+_lexical_lock = threading.Lock()
+
+#lexical_index function to return the BM25 index of a FAISS database, built from the same chunks as the database
+#the index follows the database: chunks added by streaming ingestion or removed by incremental re-indexing are synced on each call
+def lexical_index(db):
+    with _lexical_lock:
+        index = _lexical_indexes.get(db)
+        if index is None:
+            index = _lexical_indexes[db] = BM25Index()
+        current = set(db.index_to_docstore_id.values())
+        for doc_id in set(index.doc_terms) - current:
+            index.remove(doc_id)
+        for doc_id in current - set(index.doc_terms):
+            index.add(doc_id, db.docstore.search(doc_id).page_content)
+    return index
+'''_________________________________________________________________________________________________________________'''
+
+
+#context_budget function to return the number of context tokens for the selected model
+#the budget is the configured context size, reduced for models whose window cannot hold it next to the answer
+def context_budget(params):
+    window = MODELS_CONTEXT.get(params['endpoint-llm'], 4000)
+    return max(0, min(context_tokens, window - params['max_len'] - reserved_tokens))
+
+
+#pack_context function to fit the best passages into a token budget
+#passages are added in relevance order, the first one that does not fit is truncated to the remaining tokens
+#each passage is encoded once, its token ids are both counted and cut
+#returns: packed context string
+def pack_context(passages, budget, family=DEFAULT_FAMILY):
+    separator_tokens = count_tokens("\n\n", family)
+    packed = []
+    used = 0
+    for text, _ in passages:
+        tokens = encode(text, family)
+        cost = len(tokens) + (separator_tokens if packed else 0)
+        if used + cost <= budget:
+            packed.append(text)
+            used += cost
+            continue
+        remaining = budget - used - (separator_tokens if packed else 0)
+        if remaining > 0:
+            packed.append(decode(tokens[:remaining], family))
+        break
+    return "\n\n".join(packed)
+'''_________________________________________________________________________________________________________________'''
@@ -2,37 +2,139 @@
 ''' This file also contains the functions to generate summaries, key points and questions from a document using Amazon Bedrock'''
 
 import streamlit as st # import streamlit library for creating the web app
-import boto3 # import boto3 so as to Amazon Bedrock
+from clients import get_client # import the shared, pooled AWS clients to call Amazon Bedrock
 import json
-from anthropic import Anthropic
+import time # import time to measure time to first token and tokens per second of streamed answers
+import threading # import threading to run the background precompute job
+import contextvars # import contextvars to keep the session of the background precompute job
+from concurrent.futures import ThreadPoolExecutor, as_completed # import as_completed to report progress as chunk summaries complete
+from async_bedrock import submit, acall, astream, gather, concurrency # import the event loop that fans out the Bedrock calls
+from admission import request_class, estimate_tokens # import the request classes of the admission control
+from resilience import resilient_call, count # import the retry, deadline, hedging and fallback layer around Bedrock model calls
 from configparser import ConfigParser # import ConfigParser library for reading the config file
 # class from the Langchain library that splits text into smaller chunks based on specified parameters.
 from langchain.text_splitter import CharacterTextSplitter, RecursiveCharacterTextSplitter
-import tiktoken # Import tiktoken to count number of tokens
+from tokenizer import count_tokens, count_many, CLAUDE_FAMILY # Import the shared token counter
+from retrieval import retrieve, context_budget, pack_context, retrieval_mode # Import the top-k retrieval and context packing stage
+from embeddings import CachedBedrockEmbeddings # Import the embedding layer to embed questions for the answer cache
+from cache import get_cache, content_hash, SemanticAnswerCache, single_flight # Import the semantic answer cache, the response cache and the single-flight layer
+from utils import MODELS_PROMPT_CACHE # Import the LLM endpoints that support prompt caching
 '''_________________________________________________________________________________________________________________'''
 
 # Create config object and read the config file #
 config_object = ConfigParser() # Create config object
 config_object.read("./config.ini") # Read config file
-claude = Anthropic() # for Tokenizer
+
+# Semantic answer cache - near-duplicate questions on the same document, model and parameters are answered from the cache #
+answer_cache_enabled=config_object.getboolean("ANSWER_CACHE","enabled",fallback=True)
+answer_cache=SemanticAnswerCache(get_cache("answers", default_max_mb=128),
+                                 threshold=config_object.getfloat("ANSWER_CACHE","similarity_threshold",fallback=0.95),
+                                 ttl=config_object.getint("ANSWER_CACHE","ttl_seconds",fallback=86400),
+                                 max_entries=config_object.getint("ANSWER_CACHE","max_entries_per_document",fallback=256))
+ANSWER_PROMPT_VERSION="1" # Bump when the prompt in generate_response changes #
+
+# Exact-match response cache (opt-in) - identical request bodies to a model are answered from disk when sampling is effectively deterministic #
+response_cache_enabled=config_object.getboolean("RESPONSE_CACHE","enabled",fallback=False)
+deterministic_max_temperature=config_object.getfloat("RESPONSE_CACHE","max_temperature",fallback=0.05)
+response_cache=get_cache("responses", default_max_mb=256)
+
+# Prompt caching - a static prompt prefix (the whole document of a question) is cached by Bedrock for the models that support it #
+prompt_cache_enabled=config_object.getboolean("PROMPT_CACHE","enabled",fallback=True)
+prompt_cache_min_tokens=config_object.getint("PROMPT_CACHE","min_tokens",fallback=1024) # Shorter prefixes cannot be cached
+
+# Summarization - chunk summaries (map phase) run concurrently, bounded per process by [SUMMARY] max_concurrency (see async_bedrock.py) #
+summary_reduce_tokens=config_object.getint("SUMMARY","reduce_tokens",fallback=6000) # Input tokens of each prompt merging summaries
+precompute_summaries=config_object.getboolean("SUMMARY","precompute",fallback=False) # Prepare summary, key points and questions in the background after upload
+
+# Summary store - chunk summaries, final summary, key points and sample questions of a document, shared by all sessions #
+summary_store=get_cache("summaries", default_max_mb=128)
+SUMMARY_PROMPT_VERSION="4" # Bump when a summarization prompt changes #
+'''_________________________________________________________________________________________________________________'''
+
+
+# invoke_model function to call InvokeModel and return the parsed JSON response body #
+# Throttled calls are retried and may be served by a fallback model, see resilience.py #
+# Responses are cached by (model id, request body) when the response cache is enabled and the temperature makes the output deterministic #
+def invoke_model(bedrock, model_id, body, temperature):
+    key = _response_key(model_id, body, temperature)
+    if key is not None:
+        cached = response_cache.get(key)
+        if cached is not None:
+            return cached
+    def call(model):
+        response = bedrock.invoke_model(body=body, modelId=model, accept="application/json", contentType="application/json")
+        return json.loads(response['body'].read())
+    response_body, served_by = resilient_call(call, model_id)
+    if key is not None and served_by == model_id: # Answers of a fallback model are not cached as the requested model's #
+        response_cache.set(key, response_body)
+    return response_body
+
+
+# converse function to call the Converse API and return the response (output, usage and stopReason) #
+# Cached like invoke_model, the key is built from the serialized request #
+def converse(bedrock, temperature, **request):
+    key = _response_key(request['modelId'], json.dumps(request, sort_keys=True), temperature)
+    if key is not None:
+        cached = response_cache.get(key)
+        if cached is not None:
+            return cached
+    response, served_by = resilient_call(lambda model: bedrock.converse(**dict(request, modelId=model)), request['modelId'])
+    response = {'output': response['output'], 'usage': response['usage'], 'stopReason': response['stopReason']} # Drop the HTTP metadata #
+    report_prompt_cache(served_by, response['usage'])
+    if key is not None and served_by == request['modelId']:
+        response_cache.set(key, response)
+    return response
+
+
+# _response_key function to return the response cache key of a request, or None when the request must not be cached #
+def _response_key(model_id, body, temperature):
+    if not response_cache_enabled or temperature > deterministic_max_temperature:
+        return None
+    return content_hash("response", model_id, body)
 '''_________________________________________________________________________________________________________________'''
 
 
-def num_tokens_from_string(string: str, encoding_name="cl100k_base") -> int: # Function to count number of tokens in a text string #
-    encoding = tiktoken.get_encoding(encoding_name) # Initialize encoding #
-    return len(encoding.encode(string)) # Return number of tokens in the text string #
+# cacheable_prompt function to decide whether a static prompt prefix is sent as a Bedrock prompt cache checkpoint #
+# returns (cache_prefix, prompt): the prefix is kept for models that support prompt caching when it is long enough to be cached, #
+# otherwise it is prepended to the prompt and an empty prefix is returned #
+def cacheable_prompt(model_id, cache_prefix, prompt):
+    if not cache_prefix:
+        return "", prompt
+    if not prompt_cache_enabled or model_id not in MODELS_PROMPT_CACHE or count_tokens(cache_prefix) < prompt_cache_min_tokens:
+        return "", cache_prefix + prompt
+    return cache_prefix, prompt
+
+
+# prompt_content function to build the Converse message content, with a cache checkpoint after the static prefix #
+def prompt_content(cache_prefix, prompt):
+    if not cache_prefix:
+        return [{"text": prompt}]
+    return [{"text": cache_prefix}, {"cachePoint": {"type": "default"}}, {"text": prompt}]
+
+
+# report_prompt_cache function to log and count the prompt cache read and write tokens of a Converse call #
+def report_prompt_cache(model_id, usage):
+    read, write = usage.get('cacheReadInputTokens', 0), usage.get('cacheWriteInputTokens', 0)
+    if read or write:
+        count(model_id, "cache_read_tokens", read)
+        count(model_id, "cache_write_tokens", write)
+        print(f"Prompt cache {model_id}: {read} tokens read, {write} tokens written, {usage.get('inputTokens', 0)} tokens uncached")
 '''_________________________________________________________________________________________________________________'''
 
 
-def initialize_summary_session_state():
-    if "summary_flag" not in st.session_state:
-        st.session_state.summary_flag = False
-    if "summary_content" not in st.session_state:
-        st.session_state.summary_content = ""
+# bedrock_llm_call function to generate text with the selected model #
+# cache_prefix is the static start of the prompt (e.g. the document), cached by Bedrock for the models that support prompt caching #
+# and simply prepended to qa_prompt for the other models #
+# The call is interactive for the admission control (see admission.py), it goes ahead of queued summaries #
+def bedrock_llm_call(params, qa_prompt="", cache_prefix=""):
+    with request_class(interactive=True, tokens=estimate_tokens(cache_prefix + qa_prompt) + params['max_len']):
+        return _bedrock_llm_call(params, qa_prompt, cache_prefix)
 
-def bedrock_llm_call(params, qa_prompt=""):    
 
-    bedrock = boto3.client(service_name='bedrock-runtime',region_name=params['Region_Name'])
+def _bedrock_llm_call(params, qa_prompt="", cache_prefix=""):    
+
+    bedrock = get_client('bedrock-runtime',params['Region_Name'])
+    cache_prefix, qa_prompt = cacheable_prompt(params['endpoint-llm'], cache_prefix, qa_prompt)
 
     if 'claude2' in params['model_name'].lower() or 'claude instant' in params['model_name'].lower(): #or 'claude' in params['model_name'].lower():
         
@@ -44,18 +146,10 @@ def bedrock_llm_call(params, qa_prompt=""):
             "top_p": params['top_p']
         }
         prompt=json.dumps(prompt)
-        input_token = claude.count_tokens(prompt)
-        response = bedrock.invoke_model(
-            body=prompt,
-            modelId= params['endpoint-llm'], # "anthropic.claude-v2",
-            accept="application/json",
-            contentType="application/json"
-        )
-        answer=response['body'].read().decode()
-        answer=json.loads(answer)['completion']
+        response_body = invoke_model(bedrock, params['endpoint-llm'], prompt, params['temp'])
+        answer=response_body['completion']
         text = answer
-        output_token = claude.count_tokens(answer) # count the number of tokens used for output
-        total_token_consumed = input_token + output_token # count the number of total tokens used
+        output_token = count_tokens(answer, CLAUDE_FAMILY) # count the number of tokens used for output
         words=len(text.split()) # count the number of words used
         reason = ""
     elif 'ai21-j2-mid' in params['model_name'].lower() or 'ai21-j2-ultra' in params['model_name'].lower() :
@@ -67,12 +161,8 @@ def bedrock_llm_call(params, qa_prompt=""):
             "topP": params['top_p']
         })
         #prompt=json.dumps(prompt)
-        response = bedrock.invoke_model(body=prompt,
-                                modelId=params['endpoint-llm'], 
-                                accept="application/json", 
-                                contentType="application/json")
-        answer=response['body'].read().decode()
-        answer=json.loads(answer)
+        response_body = invoke_model(bedrock, params['endpoint-llm'], prompt, params['temp'])
+        answer=response_body
         #print(answer)
         input_token=len(answer['prompt']['tokens'])
         output_token=len(answer['completions'][0]['data']['tokens'])
@@ -99,15 +189,9 @@ def bedrock_llm_call(params, qa_prompt=""):
             "p": params['top_p']
         }
         prompt=json.dumps(prompt)
-        response = bedrock.invoke_model(
-            body=prompt,
-            modelId= params['endpoint-llm'], # "anthropic.claude-v2",
-            accept="application/json",
-            contentType="application/json"
-        )
+        response_body = invoke_model(bedrock, params['endpoint-llm'], prompt, params['temp'])
         
-        answer=response['body'].read().decode()
-        answer=json.loads(answer)['generations'][0]['text']
+        answer=response_body['generations'][0]['text']
         text = answer
         output_token = 200 # This is just dummy number
         words=len(text.split()) # count the number of words used
@@ -121,15 +205,8 @@ def bedrock_llm_call(params, qa_prompt=""):
         }
 
         prompt=json.dumps(prompt)
-        response = bedrock.invoke_model(
-            body=prompt,
-            modelId= params['endpoint-llm'],
-            accept="application/json",
-            contentType="application/json"
-        )
+        response_body = invoke_model(bedrock, params['endpoint-llm'], prompt, params['temp'])
 
-        body = response.get('body').read().decode('utf-8')
-        response_body = json.loads(body)
         text = response_body['generation'].strip()
         output_token = response_body['generation_token_count'] # This is just dummy number
         words = len(text.split()) # count the number of words used
@@ -144,17 +221,10 @@ def bedrock_llm_call(params, qa_prompt=""):
         }
 
         prompt=json.dumps(prompt)
-        response = bedrock.invoke_model(
-            body=prompt,
-            modelId= params['endpoint-llm'],
-            accept="application/json",
-            contentType="application/json"
-        )
+        response_body = invoke_model(bedrock, params['endpoint-llm'], prompt, params['temp'])
 
-        body = response.get('body').read().decode('utf-8')
-        response_body = json.loads(body)
         text = response_body['outputs'][0]['text']
-        output_token = num_tokens_from_string(text,encoding_name="cl100k_base")
+        output_token = count_tokens(text)
         words = len(text.split()) # count the number of words used
         reason = ""
     elif 'titan' in params['model_name'].lower():
@@ -169,15 +239,9 @@ def bedrock_llm_call(params, qa_prompt=""):
             }
         })
 
-        response = bedrock.invoke_model(
-            body=prompt,
-            modelId= params['endpoint-llm'],
-            accept="application/json",
-            contentType="application/json"
-        )
+        response_body = invoke_model(bedrock, params['endpoint-llm'], prompt, params['temp'])
         
         #==
-        response_body = json.loads(response.get("body").read())
         for result in response_body['results']:
             output_token = result['tokenCount']
             text = result['outputText']
@@ -188,11 +252,7 @@ def bedrock_llm_call(params, qa_prompt=""):
         messages_for_nova = [
                 {
                     "role": "user",
-                    "content": [
-                        {
-                            "text": qa_prompt,
-                        }
-                    ]
+                    "content": prompt_content(cache_prefix, qa_prompt)
                 }
         ]
         inf_params = {"maxTokens": 300, "topP": 0.1, "temperature": 0.3}
@@ -201,7 +261,7 @@ def bedrock_llm_call(params, qa_prompt=""):
                 "topK": 40
             }
         }
-        response = bedrock.converse(
+        response = converse(bedrock, inf_params['temperature'],
                 modelId = params['endpoint-llm'], #"us.amazon.nova-pro-v1:0", #,
                 messages = messages_for_nova,
                 # system =  [{"text": "You are an AI assistant that excels at summarizing conversations."}],
@@ -217,16 +277,12 @@ def bedrock_llm_call(params, qa_prompt=""):
         messages_for_nova = [
                 {
                     "role": "user",
-                    "content": [
-                        {
-                            "text": qa_prompt,
-                        }
-                    ]
+                    "content": prompt_content(cache_prefix, qa_prompt)
                 }
         ]
         inference_config = {"temperature": params['temp']}
         additional_model_fields = {"top_k": 40}
-        response = bedrock.converse(
+        response = converse(bedrock, params['temp'],
                 modelId = params['endpoint-llm'],
                 messages = messages_for_nova,
                 #system = [{"text": "You are an AI assistant that excels at summarizing conversations."}],
@@ -250,7 +306,7 @@ def bedrock_llm_call(params, qa_prompt=""):
             ]
             inference_config = {"temperature": params['temp']}
             additional_model_fields = {"top_k": 40}
-            response = bedrock.converse(
+            response = converse(bedrock, params['temp'],
                     modelId = params['endpoint-llm'],
                     messages = messages_for_deepseek,
                     inferenceConfig = inference_config,
@@ -261,47 +317,237 @@ def bedrock_llm_call(params, qa_prompt=""):
             reason = response["stopReason"]
 
     return text, output_token, words, reason # return the generated text, number of tokens, number of words and reason for stopping the text generation
+'''_________________________________________________________________________________________________________________'''
 
 
+# bedrock_llm_stream function to generate text with the streaming APIs and yield it as it is produced #
+# Claude 3, Nova and DeepSeek stream through ConverseStream, the other models through InvokeModelWithResponseStream #
+# AI21 Jurassic-2 does not stream, its full answer is yielded at once #
+# This function takes the following inputs: #
+# params: the selected model and inference parameters #
+# qa_prompt: the prompt, cache_prefix: its static start, see bedrock_llm_call #
+# metrics: optional dict, filled in when the stream ends with ttft_ms (time to first token), tokens, seconds and tokens_per_sec #
+# This function yields the text deltas #
+def bedrock_llm_stream(params, qa_prompt="", metrics=None, cache_prefix=""):
+    bedrock = get_client('bedrock-runtime',params['Region_Name'])
+    cache_prefix, qa_prompt = cacheable_prompt(params['endpoint-llm'], cache_prefix, qa_prompt)
+    model_name = params['model_name'].lower()
+    start = time.time()
+    first_token = None
+    output_token = None
+    text = ""
+    if 'ai21' in model_name:
+        deltas = [bedrock_llm_call(params, cache_prefix + qa_prompt)[0]]
+    elif 'nova' in model_name or 'claude3' in model_name or 'deepseek' in model_name:
+        request = _converse_request(params, qa_prompt, cache_prefix)
+        with request_class(interactive=True, tokens=estimate_tokens(cache_prefix + qa_prompt) + params['max_len']):
+            response, _ = resilient_call(lambda model: bedrock.converse_stream(**dict(request, modelId=model)), params['endpoint-llm']) # Retries cover starting the stream #
+        deltas = _converse_deltas(response['stream'], params['endpoint-llm'])
+    else:
+        body, delta_of = _invoke_stream_request(params, qa_prompt)
+        with request_class(interactive=True, tokens=estimate_tokens(qa_prompt) + params['max_len']):
+            response, _ = resilient_call(lambda model: bedrock.invoke_model_with_response_stream(body=body, modelId=model, accept="application/json", contentType="application/json"), params['endpoint-llm'])
+        deltas = _invoke_deltas(response['body'], delta_of)
+    for delta in deltas:
+        if isinstance(delta, int): # Output token count reported at the end of the stream #
+            output_token = delta
+            continue
+        if not delta:
+            continue
+        if first_token is None:
+            first_token = time.time()
+        text += delta
+        yield delta
+    end = time.time()
+    if output_token is None:
+        output_token = count_tokens(text)
+    generation_seconds = end - (first_token or end)
+    stream_metrics = {'ttft_ms': round(((first_token or end) - start) * 1000), 'tokens': output_token, 'seconds': round(end - start, 2),
+                      'tokens_per_sec': round(output_token / generation_seconds, 1) if generation_seconds > 0 else None}
+    print(f"Streamed {params['endpoint-llm']}: {stream_metrics}")
+    if metrics is not None:
+        metrics.update(stream_metrics)
+
 
-def generate_response(query,doc,params): # generate_response function    
-    prompt=f"""
+# _converse_request function to build the ConverseStream request of the Nova, Claude 3 and DeepSeek models, as in bedrock_llm_call #
+def _converse_request(params, qa_prompt, cache_prefix=""):
+    request = {'modelId': params['endpoint-llm'], 'messages': [{"role": "user", "content": prompt_content(cache_prefix, qa_prompt)}]}
+    model_name = params['model_name'].lower()
+    if 'nova' in model_name:
+        request['inferenceConfig'] = {"maxTokens": 300, "topP": 0.1, "temperature": 0.3}
+        request['additionalModelRequestFields'] = {"inferenceConfig": {"topK": 40}}
+    elif 'claude3' in model_name:
+        request['inferenceConfig'] = {"temperature": params['temp']}
+        request['additionalModelRequestFields'] = {"top_k": 40}
+    else:
+        request['inferenceConfig'] = {"temperature": params['temp']}
+    return request
+
+
+# _converse_deltas function to turn ConverseStream events into text deltas, followed by the output token count #
+def _converse_deltas(stream, model_id):
+    for event in stream:
+        if 'contentBlockDelta' in event:
+            yield event['contentBlockDelta']['delta'].get('text', "")
+        elif 'metadata' in event:
+            report_prompt_cache(model_id, event['metadata']['usage'])
+            yield event['metadata']['usage']['outputTokens']
+
+
+# _invoke_stream_request function to build the InvokeModelWithResponseStream body of a model, as in bedrock_llm_call #
+# returns the JSON body and a function extracting the text delta from a streamed chunk #
+def _invoke_stream_request(params, qa_prompt):
+    model_name = params['model_name'].lower()
+    if 'claude2' in model_name or 'claude instant' in model_name:
+        body = {"prompt": "\n\nHuman:" + qa_prompt + "\n\nAssistant:", "max_tokens_to_sample": params['max_len'],
+                "temperature": params['temp'], "top_k": 50, "top_p": params['top_p']}
+        delta_of = lambda chunk: chunk.get('completion')
+    elif 'command' in model_name:
+        body = {"prompt": qa_prompt, "max_tokens": params['max_len'], "temperature": params['temp'], "k": 50, "p": params['top_p'], "stream": True}
+        delta_of = lambda chunk: chunk.get('text')
+    elif 'llama' in model_name:
+        body = {"prompt": "[INST] "+qa_prompt + "[/INST]", "max_gen_len": params['max_len'], "temperature": params['temp'], "top_p": params['top_p']}
+        delta_of = lambda chunk: chunk.get('generation')
+    elif 'mistral' in model_name or 'mixtral' in model_name:
+        body = {"prompt": "[INST] "+qa_prompt + "[/INST]", "max_tokens": params['max_len'], "temperature": params['temp'],
+                "top_p": params['top_p'], "top_k": 50}
+        delta_of = lambda chunk: chunk['outputs'][0]['text'] if chunk.get('outputs') else None
+    elif 'titan' in model_name:
+        body = {"inputText": qa_prompt, "textGenerationConfig": {"maxTokenCount": params['max_len'], "stopSequences": [],
+                "temperature": params['temp'], "topP": params['top_p']}}
+        delta_of = lambda chunk: chunk.get('outputText')
+    else:
+        raise ValueError("Streaming is not supported for " + params['model_name'])
+    return json.dumps(body), delta_of
+
+
+# _invoke_deltas function to turn InvokeModelWithResponseStream chunks into text deltas, followed by the output token count #
+def _invoke_deltas(stream, delta_of):
+    for event in stream:
+        if 'chunk' not in event:
+            continue
+        chunk = json.loads(event['chunk']['bytes'])
+        yield delta_of(chunk)
+        invocation_metrics = chunk.get('amazon-bedrock-invocationMetrics') # Sent with the last chunk #
+        if invocation_metrics:
+            yield invocation_metrics['outputTokenCount']
+'''_________________________________________________________________________________________________________________'''
+
+
+# abedrock_llm_call and abedrock_llm_stream are the asyncio versions of bedrock_llm_call and bedrock_llm_stream #
+# They run on the event loop of async_bedrock.py, with at most [ASYNC] llm_concurrency calls in flight per process #
+async def abedrock_llm_call(params, qa_prompt="", cache_prefix=""):
+    return await acall("llm", bedrock_llm_call, params, qa_prompt, cache_prefix)
+
+
+def abedrock_llm_stream(params, qa_prompt="", metrics=None, cache_prefix=""):
+    return astream("llm", bedrock_llm_stream(params, qa_prompt, metrics, cache_prefix))
+'''_________________________________________________________________________________________________________________'''
+
+
+# answer_prompt function to build the question answering prompt from the context and the question #
+# returns (prefix, question): the context and instructions come first so that they can be cached when the context is the whole document #
+def answer_prompt(query,doc):
+    prefix=f"""
             Context: {doc}
             
             Answer the question as truthfully as possible using the above provided context and if the answer is not contained within the context provided, say "I don't know"
             Strict Instruction: provide an answer for question. Answer "don't know",if the answer is NOT available in the context.
                         
-            According to the context provided, {query}
+"""
+    question=f"""            According to the context provided, {query}
             
-            """     
-    text, t1, t2, t3=bedrock_llm_call(params,prompt) # call the bedrock_llm_call function
+            """
+    return prefix, question
+
+
+# static_context is True when doc is the same for every question (the whole document), its prompt prefix is then cached #
+def generate_response(query,doc,params,static_context=False): # generate_response function    
+    prefix,question=answer_prompt(query,doc)
+    if static_context:
+        text, t1, t2, t3=bedrock_llm_call(params,question,cache_prefix=prefix) # call the bedrock_llm_call function
+    else:
+        text, t1, t2, t3=bedrock_llm_call(params,prefix+question) # retrieved passages change with the question, caching them would only add write cost
     text_final=text # create the final answer with the result in the context
     return text_final # return the final answer
-'''_________________________________________________________________________________________________________________'''
 
 
+# generate_response_stream function to stream the answer to a question, see bedrock_llm_stream #
+# on_complete is called with the full answer once the stream ends #
+def generate_response_stream(query,doc,params,metrics=None,on_complete=None,static_context=False):
+    prefix,question=answer_prompt(query,doc)
+    if not static_context:
+        prefix,question="",prefix+question
+    text=""
+    for delta in bedrock_llm_stream(params,question,metrics,cache_prefix=prefix):
+        text+=delta
+        yield delta
+    if on_complete is not None:
+        on_complete(text)
+'''_________________________________________________________________________________________________________________'''
 
 
+# answer_question function to answer a question about a document, serving near-duplicate questions from the answer cache #
+# This function takes the following inputs: #
+# query: the question to be answered #
+# params: the selected model and inference parameters #
+# doc_hash: content hash of the document, None to bypass the cache (e.g. while the document is still being indexed) #
+# get_context: function returning the context for the question, only called on a cache miss #
+# This function returns the following outputs: #
+# text: the answer #
+# hit: the matching cache entry (with its similarity) or None when the model was called #
+# With stream=True a miss returns a generator of text deltas instead of the answer, the answer is cached when it ends #
+# and metrics (if given) is filled with the time to first token and tokens per second, see bedrock_llm_stream #
+# static_context: True when get_context returns the whole document, its prompt prefix is then cached by Bedrock #
+# The cache matches questions by their embedding, so it is bypassed in lexical retrieval mode, which makes no embedding call #
+def answer_question(query,params,doc_hash,get_context,stream=False,metrics=None,static_context=False):
+    if not answer_cache_enabled or doc_hash is None or params.get('retrieval_mode',retrieval_mode)=='lexical':
+        if stream:
+            return generate_response_stream(query,get_context(),params,metrics,static_context=static_context), None
+        return generate_response(query,get_context(),params,static_context), None
+    vector=CachedBedrockEmbeddings(params['endpoint-emb'],params['Region_Name']).embed_query(query) # reused by search_context through the query embedding cache
+    inference_params={'max_len':params['max_len'],'temp':params['temp'],'top_p':params['top_p'],'emb':params['endpoint-emb'],
+                      'retrieval_mode':params.get('retrieval_mode'),'prompt':ANSWER_PROMPT_VERSION}
+    group=answer_cache.group_key(doc_hash,params['endpoint-llm'],inference_params)
+    hit=answer_cache.lookup(group,vector)
+    if hit is not None:
+        print(f"Answer cache hit ({hit['similarity']:.3f}) for: {query} - {answer_cache.stats()}")
+        return hit['answer'], hit
+    context=get_context()
+    if stream:
+        return generate_response_stream(query,context,params,metrics,lambda text: answer_cache.add(group,vector,query,text,context),static_context), None
+    text=generate_response(query,context,params,static_context)
+    answer_cache.add(group,vector,query,text,context)
+    return text, None
+'''_________________________________________________________________________________________________________________'''
 
-# search_context function to search the database for the most relevant section to the user question #
+
+# search_context function to search the database for the most relevant sections to the user question #
 # This function takes the following inputs: #
 # db: the database with embeddings to be used for answering the question #
 # query: the question to be answered #
+# params: the selected model and inference parameters, used to size the context #
 # This function returns the following outputs: #
-# defin[0].page_content: the most relevant section to the user question #
-def search_context(db,query): # search_context function
-     defin=db.similarity_search(query) # call the FAISS similarity_search function that searches the database for the most relevant section to the user question and orders the results in descending order of relevance
-     return defin[0].page_content # return the most relevant section to the user question
+# context: the top-k relevant sections, de-duplicated and packed into the token budget of the selected model #
+def search_context(db,query,params): # search_context function
+     passages=retrieve(db,query,mode=params.get('retrieval_mode',retrieval_mode)) # top-k passages (vector, lexical or hybrid) in descending order of relevance, overlapping chunks merged
+     return pack_context(passages,context_budget(params)) # return the best passages that fit the model's context budget
 '''_________________________________________________________________________________________________________________'''
 
 
-def summarizer(prompt_data,params,initial_token_count):    
+# summarizer calls are background work for the admission control (see admission.py) #
+def summarizer(prompt_data,params,initial_token_count):
+    with request_class(interactive=False, tokens=estimate_tokens(prompt_data) + params['max_len']):
+        return _summarizer(prompt_data,params,initial_token_count)
+
+
+def _summarizer(prompt_data,params,initial_token_count):    
     """
     This function creates the summary of each individual chunk as well as the final summary.
     :param prompt_data: This is the prompt along with the respective chunk of text, at the end it contains all summary chunks combined.
     :return: A summary of the respective chunk of data passed in or the final summary that is a summary of all summary chunks.
     """
-    bedrock = boto3.client(service_name='bedrock-runtime',region_name=params['Region_Name'])
+    bedrock = get_client('bedrock-runtime',params['Region_Name'])
     if initial_token_count > 2500: # if the token count of the document is more than 2500, prefer using Claude v2 for Summarization
         prompt = {
             "prompt": "\n\nHuman:" + prompt_data + "\n\nAssistant:",
@@ -311,16 +557,9 @@ def summarizer(prompt_data,params,initial_token_count):
             "top_p": params['top_p']
         }
         prompt=json.dumps(prompt)
-        input_token = claude.count_tokens(prompt)
-        response = bedrock.invoke_model(
-            body=prompt,
-            modelId= "anthropic.claude-v2",  #params['endpoint-llm'],
-            accept="application/json",
-            contentType="application/json"
-        )
+        response_body = invoke_model(bedrock, "anthropic.claude-v2", prompt, params['temp']) #params['endpoint-llm']
         
-        answer=response['body'].read().decode()
-        answer=json.loads(answer)['completion']
+        answer=response_body['completion']
     else:
 
         if 'claude2' in params['model_name'].lower() or 'claude instant' in params['model_name'].lower():
@@ -333,16 +572,9 @@ def summarizer(prompt_data,params,initial_token_count):
                 "top_p": params['top_p']
             }
             prompt=json.dumps(prompt)
-            input_token = claude.count_tokens(prompt)
-            response = bedrock.invoke_model(
-                body=prompt,
-                modelId= params['endpoint-llm'],
-                accept="application/json",
-                contentType="application/json"
-            )
+            response_body = invoke_model(bedrock, params['endpoint-llm'], prompt, params['temp'])
             
-            answer=response['body'].read().decode()
-            answer=json.loads(answer)['completion']
+            answer=response_body['completion']
             
         elif 'ai21-j2-mid' in params['model_name'].lower() or 'ai21-j2-ultra' in params['model_name'].lower():
             prompt={
@@ -356,12 +588,8 @@ def summarizer(prompt_data,params,initial_token_count):
             "frequencyPenalty": {"scale": 0.8 }
             }
             prompt=json.dumps(prompt)
-            response = bedrock.invoke_model(body=prompt,
-                                    modelId=params['endpoint-llm'], 
-                                    accept="application/json", 
-                                    contentType="application/json")
-            answer=response['body'].read().decode()
-            answer=json.loads(answer)
+            response_body = invoke_model(bedrock, params['endpoint-llm'], prompt, params['temp'])
+            answer=response_body
             #input_token=len(answer['prompt']['tokens'])
             #output_token=len(answer['completions'][0]['data']['tokens'])
             answer=answer['completions'][0]['data']['text']
@@ -381,15 +609,9 @@ def summarizer(prompt_data,params,initial_token_count):
                 "p": params['top_p']
             }
             prompt=json.dumps(prompt)
-            response = bedrock.invoke_model(
-                body=prompt,
-                modelId= params['endpoint-llm'], # "anthropic.claude-v2",
-                accept="application/json",
-                contentType="application/json"
-            )
+            response_body = invoke_model(bedrock, params['endpoint-llm'], prompt, params['temp'])
             
-            answer=response['body'].read().decode()
-            answer=json.loads(answer)['generations'][0]['text']
+            answer=response_body['generations'][0]['text']
         
         elif 'llama2' in params['model_name'].lower():
             prompt = {
@@ -400,15 +622,8 @@ def summarizer(prompt_data,params,initial_token_count):
             }
 
             prompt=json.dumps(prompt)
-            response = bedrock.invoke_model(
-                body=prompt,
-                modelId= params['endpoint-llm'],
-                accept="application/json",
-                contentType="application/json"
-            )
+            response_body = invoke_model(bedrock, params['endpoint-llm'], prompt, params['temp'])
 
-            body = response.get('body').read().decode('utf-8')
-            response_body = json.loads(body)
             answer = response_body['generation'].strip()
         elif 'mistral' in params['model_name'].lower() or 'mixtral' in params['model_name'].lower():
             prompt = {
@@ -420,15 +635,8 @@ def summarizer(prompt_data,params,initial_token_count):
             }
 
             prompt=json.dumps(prompt)
-            response = bedrock.invoke_model(
-                body=prompt,
-                modelId= params['endpoint-llm'],
-                accept="application/json",
-                contentType="application/json"
-            )
+            response_body = invoke_model(bedrock, params['endpoint-llm'], prompt, params['temp'])
 
-            body = response.get('body').read().decode('utf-8')
-            response_body = json.loads(body)
             answer = response_body['outputs'][0]['text']
         elif 'titan' in params['model_name'].lower():
 
@@ -442,15 +650,9 @@ def summarizer(prompt_data,params,initial_token_count):
                 }
             })
 
-            response = bedrock.invoke_model(
-                body=prompt,
-                modelId= params['endpoint-llm'],
-                accept="application/json",
-                contentType="application/json"
-            )
+            response_body = invoke_model(bedrock, params['endpoint-llm'], prompt, params['temp'])
             
             #==
-            response_body = json.loads(response.get("body").read())
             for result in response_body['results']:
                 #output_token = result['tokenCount']
                 answer = result['outputText']
@@ -474,7 +676,7 @@ def summarizer(prompt_data,params,initial_token_count):
                     "topK": 40
                 }
             }
-            response = bedrock.converse(
+            response = converse(bedrock, inf_params['temperature'],
                     modelId = params['endpoint-llm'], #"us.amazon.nova-pro-v1:0", #,
                     messages = messages_for_nova,
                     # system =  [{"text": "You are an AI assistant that excels at summarizing conversations."}],
@@ -496,7 +698,7 @@ def summarizer(prompt_data,params,initial_token_count):
             ]
             inference_config = {"temperature": params['temp']}
             additional_model_fields = {"top_k": 40}
-            response = bedrock.converse(
+            response = converse(bedrock, params['temp'],
                     modelId = params['endpoint-llm'],
                     messages = messages_for_nova,
                     #system = [{"text": "You are an AI assistant that excels at summarizing conversations."}],
@@ -518,7 +720,7 @@ def summarizer(prompt_data,params,initial_token_count):
             ]
             inference_config = {"temperature": params['temp']}
             additional_model_fields = {"top_k": 40}
-            response = bedrock.converse(
+            response = converse(bedrock, params['temp'],
                     modelId = params['endpoint-llm'],
                     messages = messages_for_deepseek,
                     inferenceConfig = inference_config,
@@ -528,14 +730,12 @@ def summarizer(prompt_data,params,initial_token_count):
     return answer
 
 
-def generate_summarized_content(info,params,token): # summary function
-    # We need to split the text using Character Text Split such that it should not increase token size
-    text_splitter = CharacterTextSplitter(
-        separator = "\n",
-        chunk_size = 10000,
-        chunk_overlap  = 2000,
-        length_function = len,
-    )
+# generate_summarized_content function to summarize each chunk of a document (map phase) #
+# Chunks are summarized concurrently on the event loop (see async_bedrock.py), the summaries are kept in document order #
+# on_progress(done, total) is called as chunks complete, by default a progress bar is shown #
+# returns the list of chunk summaries in document order, or None if cancel (a threading.Event) is set before they are all done #
+def generate_summarized_content(info,params,token,on_progress=None,cancel=None): # summary function
+    # We need to split the text such that it should not increase token size
     splitter = RecursiveCharacterTextSplitter(
         separators=["\n\n", "\n", " ", ""],
         chunk_size=10000, 
@@ -544,24 +744,236 @@ def generate_summarized_content(info,params,token): # summary function
         add_start_index=True
     )
     texts = splitter.create_documents([info])
-    # Creating an empty summary string, as this is where we will append the summary of each chunk
-    summary = ""
-    # looping through each chunk of text we created, passing that into our prompt and generating a summary of that chunk
-    for index, chunk in enumerate(texts):
-        # gathering the text content of that specific chunk
+    progress_bar = None
+    if on_progress is None:
+        progress_bar = st.progress(0.0, text=f"Summarizing {len(texts)} sections of the document")
+        on_progress = lambda done, total: progress_bar.progress(done / total, text=f"Summarized {done} of {total} sections")
+    prompts = []
+    # creating the prompt that will be passed into Bedrock with the text content of each chunk
+    for chunk in texts:
         chunk_content = chunk.page_content
-        # creating the prompt that will be passed into Bedrock with the text content of the chunk
-        prompt = f"""\n\nHuman: Provide a detailed summary for the chunk of text provided to you:
+        prompts.append(f"""\n\nHuman: Provide a detailed summary for the chunk of text provided to you:
         Text: {chunk_content}
-        \n\nAssistant:"""
-        # passing the prompt into the summarizer function to generate the summary of that chunk, and appending it to
-        # the summary string
-        summary += summarizer(prompt,params,token)
+        \n\nAssistant:""")
+    start = time.time()
+    futures = {submit(acall("summary", summarizer, prompt, params, token)): index for index, prompt in enumerate(prompts)}
+    chunk_summaries = [None] * len(prompts)
+    for done, future in enumerate(as_completed(futures), start=1):
+        if cancel is not None and cancel.is_set(): # Drop the chunks that have not started #
+            for pending in futures:
+                pending.cancel()
+            return None
+        chunk_summaries[futures[future]] = future.result()
+        on_progress(done, len(prompts))
+    if progress_bar is not None:
+        progress_bar.empty()
+    print(f"Summarized {len(prompts)} chunks in {time.time() - start:.1f}s with up to {concurrency['summary']} concurrent calls")
+    return chunk_summaries # in the order of the chunks, whatever order they completed in
+
+
+# reduce_summaries function to reduce chunk summaries level by level until they fit into one prompt (tree reduction) #
+# At each level consecutive summaries are grouped to fit the reduce token budget and every group is merged concurrently on the event loop #
+# Groups hold at least two summaries, so every level about halves their number and the depth grows with log(chunks) #
+# This function returns the following outputs: #
+# summaries: partial summaries in document order, together at most the reduce budget (or a single summary) #
+# levels: one report per level with the number of inputs, groups and input tokens #
+def reduce_summaries(summaries,params,token):
+    budget = max(summary_reduce_tokens, 2 * params['max_len']) # A group always fits two summaries of max_len tokens #
+    levels = []
+    token_counts = count_many(summaries)
+    while len(summaries) > 1 and sum(token_counts) > budget:
+        groups = _token_groups(token_counts, budget)
+        merged = [(start, stop) for start, stop in groups if stop - start > 1]
+        prompts = [f"""\n\nHuman: You will be given consecutive summaries from one part of a document. Merge them into a single 
+        detailed summary that keeps all key points, in the order they appear.
+        Summaries: {chr(10).join(summaries[start:stop])}
+        \n\nAssistant:""" for start, stop in merged]
+        level_start = time.time()
+        reduced = dict(zip(merged, gather("summary", [(summarizer, (prompt, params, token)) for prompt in prompts])))
+        levels.append({'level': len(levels) + 1, 'inputs': len(summaries), 'groups': len(groups), 'input_tokens': sum(token_counts),
+                       'max_prompt_tokens': max(sum(token_counts[start:stop]) for start, stop in groups), 'seconds': round(time.time() - level_start, 1)})
+        print(f"Summary reduction level {levels[-1]}")
+        fresh = dict(zip(merged, count_many([reduced[group] for group in merged]))) # Summaries passed through keep their count #
+        token_counts = [fresh[group] if group in reduced else token_counts[group[0]] for group in groups]
+        summaries = [reduced[group] if group in reduced else summaries[group[0]] for group in groups]
+    return summaries, levels
+
+
+# _token_groups function to split consecutive token counts into (start, stop) groups of at most budget tokens #
+# every group but the last holds at least two items, a single item left over is passed to the next level unchanged #
+def _token_groups(token_counts, budget):
+    groups = []
+    start = 0
+    while start < len(token_counts):
+        stop = start + 1
+        used = token_counts[start]
+        while stop < len(token_counts) and (stop - start < 2 or used + token_counts[stop] <= budget):
+            used += token_counts[stop]
+            stop += 1
+        groups.append((start, stop))
+        start = stop
+    return groups
 
-    return summary
 
 '''_________________________________________________________________________________________________________________'''
 
+# summary_key function to return the summary store key of an artifact of a document #
+# artifact is chunks, reduced, summary, key_points or questions, the key covers everything that changes it: #
+# the document, the model that summarizes (Claude v2 for long documents, see summarizer), the inference params and the prompt version #
+def summary_key(artifact,info,params,token):
+    model_id = "anthropic.claude-v2" if token > 2500 else params['endpoint-llm']
+    inference_params = {'max_len':params['max_len'],'temp':params['temp'],'top_p':params['top_p']}
+    return content_hash("summary", artifact, SUMMARY_PROMPT_VERSION, content_hash(info), model_id, repr(sorted(inference_params.items())))
+
+
+# chunk_summaries function to return the chunk summaries of a document from the summary store, generating them on a miss #
+# Sessions asking for the same document at the same time wait for one of them to summarize it (single flight) #
+# returns None if cancel is set before all chunks are summarized #
+def chunk_summaries(info,params,token,on_progress=None,cancel=None):
+    key = summary_key("chunks",info,params,token)
+    summaries = summary_store.get(key)
+    if summaries is not None:
+        return summaries
+    if on_progress is None and single_flight.in_flight(key): # The progress bar is shown by the call that summarizes #
+        with st.spinner('This document is already being summarized, waiting for the section summaries'):
+            return single_flight.do(key,_chunk_summaries,key,info,params,token,on_progress,cancel)
+    return single_flight.do(key,_chunk_summaries,key,info,params,token,on_progress,cancel)
+
+
+def _chunk_summaries(key,info,params,token,on_progress,cancel): # Map phase run once per key by chunk_summaries #
+    summaries = summary_store.get(key) # A call that finished after the lookup in chunk_summaries may have stored them #
+    if summaries is None:
+        summaries = generate_summarized_content(info,params,token,on_progress,cancel)
+        if summaries is not None:
+            summary_store.set(key,summaries)
+    return summaries
+
+
+# reduced_summaries function to return the chunk summaries of a document reduced to the reduce token budget (see reduce_summaries) #
+# The reduction is stored and shared by final_summary, key_points and sample_questions, so it runs once per document #
+# returns: (summaries, levels), levels is empty when the reduction was stored before #
+def reduced_summaries(info,params,token,summaries):
+    key = summary_key("reduced",info,params,token)
+    reduced = summary_store.get(key)
+    if reduced is not None:
+        return reduced, []
+    return single_flight.do(key,_reduced_summaries,key,params,token,summaries)
+
+
+def _reduced_summaries(key,params,token,summaries): # Reduce phase run once per key by reduced_summaries #
+    reduced = summary_store.get(key)
+    if reduced is not None:
+        return reduced, []
+    reduced, levels = reduce_summaries(summaries,params,token)
+    summary_store.set(key,reduced)
+    return reduced, levels
+
+
+# final_summary, key_points and sample_questions functions generate an artifact from the chunk summaries and store it #
+# Their prompts are built from the reduced summaries, so they stay within the model context whatever the document length #
+# They do not use Streamlit, so the background precompute job can call them #
+def final_summary(info,params,token,summaries):
+    summaries, levels = reduced_summaries(info,params,token,summaries) # bounds the final prompt whatever the document length
+    final_summary_prompt = f"""\n\nHuman: You will be given a set of summaries from a document. Create a cohesive 
+    summary from the provided individual summaries. The summary should very crisp and at max 700 wrods. 
+    Summaries: {"".join(summaries)}
+            \n\nAssistant:"""
+    
+    #prompt="Review the summaries from multiple pieces of a single document below:\n"+info+".\n Merge the summaries into a single coherent and cohesive narrative highlighting all key points and produce the summary in 500 words." # create the prompt asking LLM to generate a summary of the document
+    text = summarizer(final_summary_prompt,params,token)
+    summary_store.set(summary_key("summary",info,params,token),text)
+    return text, levels
+
+
+def key_points(info,params,token,summaries):
+    summaries, _ = reduced_summaries(info,params,token,summaries)
+    prompt="In short bullet points, extract all the main talking points of the text below:\n"+"".join(summaries)+".\nDo not add any pretext or context. Write each bullet in a new line." # create the prompt asking Bedrock to generate key points of the document
+    text = summarizer(prompt,params,token) # call the summarizer function
+    summary_store.set(summary_key("key_points",info,params,token),text)
+    return text
+
+
+def sample_questions(info,params,token,summaries):
+    summaries, _ = reduced_summaries(info,params,token,summaries)
+    prompt="Extract ten questions that can be asked of the text below:\n"+"".join(summaries)+".\nDo not add any pretext or context." # create the prompt asking openai to generate questions from the document
+    text = summarizer(prompt,params,token) # call the summarizer function
+    summary_store.set(summary_key("questions",info,params,token),text)
+    return text
+'''_________________________________________________________________________________________________________________'''
+
+
+# start_precompute function to prepare the summary, key points and sample questions of a document in a background thread #
+# The chunk summaries are generated once, then the three artifacts are generated concurrently #
+# returns: job dict with chunks/chunks_done (progress), done, error, cancel (threading.Event) and ready (artifact -> threading.Event) #
+def start_precompute(info,params,token):
+    job = {
+        'chunks': 0, 'chunks_done': 0, 'done': False, 'error': None, 'cancel': threading.Event(),
+        'ready': {artifact: threading.Event() for artifact in ("summary", "key_points", "questions")},
+    }
+    thread = threading.Thread(target=contextvars.copy_context().run, args=(_run_precompute, job, info, params, token), daemon=True) # Keeps the session for admission #
+    thread.start()
+    return job
+
+
+#_run_precompute function is the body of the precompute thread
+def _run_precompute(job,info,params,token):
+    try:
+        def on_progress(done, total):
+            job['chunks_done'], job['chunks'] = done, total
+        summaries = chunk_summaries(info,params,token,on_progress,job['cancel'])
+        if summaries is None or job['cancel'].is_set(): # A different file was uploaded #
+            return
+        with ThreadPoolExecutor(max_workers=3, thread_name_prefix="summary-precompute") as pool: # Own threads, the reduction waits on the event loop #
+            futures = {pool.submit(contextvars.copy_context().run, single_flight.do, summary_key(artifact,info,params,token), generate, info, params, token, summaries): artifact
+                       for artifact, generate in (("summary", final_summary), ("key_points", key_points), ("questions", sample_questions))}
+            for future in as_completed(futures):
+                future.result()
+                job['ready'][futures[future]].set()
+        print("Precomputed summary, key points and questions in the background")
+    except Exception as e:
+        print(f"Background summarization failed: {e}")
+        job['error'] = e
+    finally:
+        job['done'] = True
+        for ready in job['ready'].values(): # Waiting sessions generate the artifact themselves on failure or cancellation #
+            ready.set()
+
+
+#get_precompute function to return the precompute job of a document for this session, starting it if needed
+#a job for a different document or model is cancelled
+def get_precompute(info,params,token):
+    key = summary_key("precompute",info,params,token)
+    current = st.session_state.get('precompute')
+    if current is not None and current['key'] == key:
+        return current
+    if current is not None:
+        current['cancel'].set()
+    job = start_precompute(info,params,token)
+    job['key'] = key
+    st.session_state['precompute'] = job
+    return job
+
+
+#cancel_precompute function to stop the precompute job of this session, e.g. when the document is removed
+def cancel_precompute():
+    job = st.session_state.pop('precompute', None)
+    if job is not None:
+        job['cancel'].set()
+
+
+#_precomputed function to wait for an artifact being prepared by this session's precompute job
+#returns: the stored artifact, or None if there is no job for this document or it did not produce the artifact
+def _precomputed(artifact,info,params,token):
+    job = st.session_state.get('precompute')
+    if job is None or job['key'] != summary_key("precompute",info,params,token) or job['cancel'].is_set():
+        return None
+    if not job['ready'][artifact].is_set():
+        with st.spinner('Finishing the '+artifact.replace("_"," ")+' prepared in the background'):
+            job['ready'][artifact].wait()
+    return summary_store.get(summary_key(artifact,info,params,token))
+'''_________________________________________________________________________________________________________________'''
+
+
 # summarize function to generate a summary of a document #
 # This function takes the following inputs: #
 # info: the document to be summarized #
@@ -569,22 +981,16 @@ def generate_summarized_content(info,params,token): # summary function
 # This function returns the following outputs: #
 # text: the generated summary #
 def summary(info,params,token): # summary function
-    initialize_summary_session_state()
-    if st.session_state.summary_flag:
+    text = summary_store.get(summary_key("summary",info,params,token)) or _precomputed("summary",info,params,token)
+    if text is not None:
         print("Already Summarized")
-        summary = st.session_state.summary_content
-    else:
-        summary = generate_summarized_content(info,params,token)
-        st.session_state.summary_flag = True
-        st.session_state.summary_content = summary
-    final_summary_prompt = f"""\n\nHuman: You will be given a set of summaries from a document. Create a cohesive 
-    summary from the provided individual summaries. The summary should very crisp and at max 700 wrods. 
-    Summaries: {summary}
-            \n\nAssistant:"""
-    
-    #prompt="Review the summaries from multiple pieces of a single document below:\n"+info+".\n Merge the summaries into a single coherent and cohesive narrative highlighting all key points and produce the summary in 500 words." # create the prompt asking LLM to generate a summary of the document
+        return text
+    summaries = chunk_summaries(info,params,token)
     with st.spinner('Summarizing your uploaded document'): # wait while Bedrock response is awaited
-        text = summarizer(final_summary_prompt,params,token)
+        text, levels = single_flight.do(summary_key("summary",info,params,token),final_summary,info,params,token,summaries) # shared with sessions summarizing the same document
+    if levels:
+        st.caption(f"Merged {levels[0]['inputs']} section summaries in {len(levels)} levels: " +
+                   ", ".join(f"{level['input_tokens']} tokens into {level['groups']}" for level in levels))
     return text # return the generated summary
 
 '''_________________________________________________________________________________________________________________'''
@@ -597,18 +1003,12 @@ def summary(info,params,token): # summary function
 # This function returns the following outputs: #
 # text: the generated key points #
 def generate_insights(info,params,token): # generate_insights function
-    initialize_summary_session_state()
-    if st.session_state.summary_flag:
-        print("Already Summarized")
-        summary_for_talking_points = st.session_state.summary_content
-    else:
-        summary_for_talking_points = generate_summarized_content(info,params,token)
-        st.session_state.summary_flag = True
-        st.session_state.summary_content = summary_for_talking_points
-
-    prompt="In short bullet points, extract all the main talking points of the text below:\n"+summary_for_talking_points+".\nDo not add any pretext or context. Write each bullet in a new line." # create the prompt asking Bedrock to generate key points of the document
+    text = summary_store.get(summary_key("key_points",info,params,token)) or _precomputed("key_points",info,params,token)
+    if text is not None:
+        return text
+    summary_for_talking_points = chunk_summaries(info,params,token)
     with st.spinner('Extracting the key points'): # wait while Bedrock response is awaited
-       text = summarizer(prompt,params,token) # call the summarizer function
+       text = single_flight.do(summary_key("key_points",info,params,token),key_points,info,params,token,summary_for_talking_points)
     return text # return the generated key points
 '''_________________________________________________________________________________________________________________'''
 
@@ -620,16 +1020,12 @@ def generate_insights(info,params,token): # generate_insights function
 # This function returns the following outputs: #
 # text: the generated questions #
 def generate_questions(info,params,token): # generate_questions function
-    initialize_summary_session_state()
-    if st.session_state.summary_flag:
-        summary_for_questions_gen = st.session_state.summary_content
-    else:
-        summary_for_questions_gen = generate_summarized_content(info,params,token)
-        st.session_state.summary_flag = True
-        st.session_state.summary_content = summary_for_questions_gen
-    prompt="Extract ten questions that can be asked of the text below:\n"+summary_for_questions_gen+".\nDo not add any pretext or context." # create the prompt asking openai to generate questions from the document
+    text = summary_store.get(summary_key("questions",info,params,token)) or _precomputed("questions",info,params,token)
+    if text is not None:
+        return text
+    summary_for_questions_gen = chunk_summaries(info,params,token)
 
     with st.spinner('Generating a few sample questions'): # wait while Bedrock response is awaited
-        text = summarizer(prompt,params,token) # call the summarizer function
+        text = single_flight.do(summary_key("questions",info,params,token),sample_questions,info,params,token,summary_for_questions_gen)
     return text # return the generated questions
 '''_________________________________________________________________________________________________________________'''
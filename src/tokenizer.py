@@ -0,0 +1,138 @@
+''' tokenizer.py contains the token counting shared by all modules of RAG_Chatbot'''
+''' One encoder per model family is created per process. Large texts are encoded in parallel batches and very large texts can be'''
+''' counted approximately from evenly spaced samples. Run "python src/tokenizer.py [chars]" to compare the exact and approximate counts'''
+
+import sys # Import sys to read the benchmark arguments
+import time # Import time for the benchmark
+import random # Import random to build the benchmark text
+from functools import lru_cache # Import lru_cache to create each encoder once
+import tiktoken # Import tiktoken for the cl100k_base encoding used by most models
+from anthropic import Anthropic # Import Anthropic for the tokenizer of Claude v2 and Claude Instant
+from configparser import ConfigParser # Import ConfigParser library for reading the tokenizer settings
+
+config_object = ConfigParser()
+config_object.read("config.ini")
+batch_chars=config_object.getint("TOKENIZER","batch_chars",fallback=100000) # Characters per batch when a large text is encoded in parallel
+num_threads=config_object.getint("TOKENIZER","num_threads",fallback=4) # Threads encoding the batches (the encoders release the GIL)
+approximate_chars=config_object.getint("TOKENIZER","approximate_chars",fallback=4000000) # count_tokens samples texts at least this long, 0 always counts exactly
+sample_chars=config_object.getint("TOKENIZER","sample_chars",fallback=200000) # Characters encoded to approximate a count
+sample_count=8 # Evenly spaced samples, so that a document changing style half way is still counted well
+
+DEFAULT_FAMILY="cl100k_base" # tiktoken encoding used for every model without its own tokenizer
+CLAUDE_FAMILY="claude" # Claude v2 and Claude Instant (text completion API)
+'''_________________________________________________________________________________________________________________'''
+
+
+# ClaudeEncoder gives the Anthropic tokenizer (a Hugging Face tokenizers.Tokenizer) the interface of a tiktoken encoding #
+class ClaudeEncoder:
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+
+    def encode_ordinary(self, text):
+        return self.tokenizer.encode(text).ids
+
+    def encode_ordinary_batch(self, texts, num_threads=num_threads): # tokenizers parallelizes batches itself #
+        return [encoding.ids for encoding in self.tokenizer.encode_batch(texts)]
+
+    def decode(self, ids):
+        return self.tokenizer.decode(ids)
+
+
+#get_encoder function to return the encoder of a model family, created once per process
+#parameters: "family" is a tiktoken encoding name or CLAUDE_FAMILY
+@lru_cache(maxsize=None)
+def get_encoder(family=DEFAULT_FAMILY):
+    if family == CLAUDE_FAMILY:
+        return ClaudeEncoder(Anthropic().get_tokenizer())
+    return tiktoken.get_encoding(family)
+'''_________________________________________________________________________________________________________________'''
+
+
+#encode function to return the token ids of a text, so that callers that count and then cut (e.g. pack_context) tokenize once
+#texts longer than two batches are encoded in parallel batches cut before a space, where the encoders split words anyway
+#special tokens in the text (e.g. <|endoftext|>) are encoded as ordinary text
+def encode(text, family=DEFAULT_FAMILY):
+    encoder = get_encoder(family)
+    if len(text) < 2 * batch_chars:
+        return encoder.encode_ordinary(text)
+    ids = []
+    for batch_ids in encoder.encode_ordinary_batch(_batches(text), num_threads=num_threads):
+        ids.extend(batch_ids)
+    return ids
+
+
+#decode function to return the text of token ids
+def decode(ids, family=DEFAULT_FAMILY):
+    return get_encoder(family).decode(ids)
+
+
+#count_tokens function to count the tokens of a text
+#parameters: "exact" forces an exact count, otherwise texts of approximate_chars or more are counted with approximate_tokens
+#returns: number of tokens
+def count_tokens(text, family=DEFAULT_FAMILY, exact=False):
+    if not text:
+        return 0
+    if not exact and approximate_chars and len(text) >= approximate_chars:
+        return approximate_tokens(text, family)
+    encoder = get_encoder(family)
+    if len(text) < 2 * batch_chars:
+        return len(encoder.encode_ordinary(text))
+    return sum(len(ids) for ids in encoder.encode_ordinary_batch(_batches(text), num_threads=num_threads))
+
+
+#count_many function to count the tokens of several texts in one parallel batch
+#returns: list of token counts in the order of the texts
+def count_many(texts, family=DEFAULT_FAMILY):
+    if not texts:
+        return []
+    return [len(ids) for ids in get_encoder(family).encode_ordinary_batch(list(texts), num_threads=num_threads)]
+
+
+#approximate_tokens function to estimate the tokens of a text from sample_count evenly spaced samples of sample_chars in total
+#the tokens per character of the samples are scaled to the length of the text, the cost does not grow with the text
+def approximate_tokens(text, family=DEFAULT_FAMILY):
+    if len(text) <= sample_chars:
+        return count_tokens(text, family, exact=True)
+    size = sample_chars // sample_count
+    step = len(text) // sample_count
+    samples = [text[i * step:i * step + size] for i in range(sample_count)]
+    sampled_tokens = sum(count_many(samples, family))
+    return round(sampled_tokens * len(text) / sum(len(sample) for sample in samples))
+
+
+#_batches function to cut a text into pieces of about batch_chars, each cut made before a space
+def _batches(text):
+    batches = []
+    start = 0
+    while start < len(text):
+        stop = min(start + batch_chars, len(text))
+        if stop < len(text):
+            space = text.rfind(" ", start + batch_chars // 2, stop)
+            if space > start:
+                stop = space
+        batches.append(text[start:stop])
+        start = stop
+    return batches
+'''_________________________________________________________________________________________________________________'''
+
+
+#benchmark function to compare the exact count (single call and parallel batches) with the approximate count of a generated text
+def benchmark(chars=5000000):
+    words = ["token", "retrieval", "summary", "Bedrock", "1234", "the", "of", "document,", "chunk.", "\n\n"]
+    text = " ".join(random.choice(words) for _ in range(chars // 6))
+    encoder = get_encoder()
+    start = time.time()
+    single = len(encoder.encode_ordinary(text))
+    single_ms = (time.time() - start) * 1000
+    start = time.time()
+    batched = count_tokens(text, exact=True)
+    batched_ms = (time.time() - start) * 1000
+    start = time.time()
+    approximate = approximate_tokens(text)
+    approximate_ms = (time.time() - start) * 1000
+    print(f"{len(text)} characters: single call {single} tokens in {single_ms:.0f}ms, parallel batches {batched} tokens in {batched_ms:.0f}ms, "
+          f"approximate {approximate} tokens ({(approximate - single) / single:+.2%}) in {approximate_ms:.0f}ms")
+
+
+if __name__ == "__main__":
+    benchmark(*(int(arg) for arg in sys.argv[1:2]))
@@ -17,19 +17,19 @@ region_name='<AWS_Region>'
 
 application_metadata = {
      'models-llm':[
-        {'name': 'Nova-Pro','endpoint':"us.amazon.nova-pro-v1:0"},
-        {'name': 'claude3.5-sonnetV2','endpoint':"us.anthropic.claude-3-5-sonnet-20241022-v2:0"},
-        {'name':'claude3-sonnet', 'endpoint':"anthropic.claude-3-sonnet-20240229-v1:0"},
-        {'name': 'claude3.5-sonnet','endpoint':"anthropic.claude-3-5-sonnet-20240620-v1:0"},
-        {'name': 'deepseek-R1','endpoint':"us.deepseek.r1-v1:0"},
-        {'name':'AI21-J2-mid', 'endpoint':'ai21.j2-mid'},
-        {'name':'AI21-J2-ultra', 'endpoint':'ai21.j2-ultra-v1'},
-        {'name':'Cohere Command', 'endpoint':"cohere.command-text-v14"},
-        {'name':'Titan', 'endpoint':"amazon.titan-text-express-v1"},
-        {'name':'Llama3-8b-instruct', 'endpoint':"meta.llama3-8b-instruct-v1:0"},
-        {'name':'Llama-31-70b-instruct', 'endpoint':"meta.llama3-1-70b-instruct-v1:0"},
-        {'name':'mistral-7b', 'endpoint':"mistral.mistral-7b-instruct-v0:2"},
-        {'name':'mixtral-8x7b-instruct', 'endpoint':"mistral.mixtral-8x7b-instruct-v0:1"}
+        {'name': 'Nova-Pro','endpoint':"us.amazon.nova-pro-v1:0", 'context':300000, 'prompt_cache':True},
+        {'name': 'claude3.5-sonnetV2','endpoint':"us.anthropic.claude-3-5-sonnet-20241022-v2:0", 'context':200000, 'prompt_cache':True},
+        {'name':'claude3-sonnet', 'endpoint':"anthropic.claude-3-sonnet-20240229-v1:0", 'context':200000},
+        {'name': 'claude3.5-sonnet','endpoint':"anthropic.claude-3-5-sonnet-20240620-v1:0", 'context':200000},
+        {'name': 'deepseek-R1','endpoint':"us.deepseek.r1-v1:0", 'context':128000},
+        {'name':'AI21-J2-mid', 'endpoint':'ai21.j2-mid', 'context':8191},
+        {'name':'AI21-J2-ultra', 'endpoint':'ai21.j2-ultra-v1', 'context':8191},
+        {'name':'Cohere Command', 'endpoint':"cohere.command-text-v14", 'context':4000},
+        {'name':'Titan', 'endpoint':"amazon.titan-text-express-v1", 'context':8000},
+        {'name':'Llama3-8b-instruct', 'endpoint':"meta.llama3-8b-instruct-v1:0", 'context':8000},
+        {'name':'Llama-31-70b-instruct', 'endpoint':"meta.llama3-1-70b-instruct-v1:0", 'context':128000},
+        {'name':'mistral-7b', 'endpoint':"mistral.mistral-7b-instruct-v0:2", 'context':32000},
+        {'name':'mixtral-8x7b-instruct', 'endpoint':"mistral.mixtral-8x7b-instruct-v0:1", 'context':32000}
        ],
     'models-emb':[
         {'name':'Titan', 'endpoint':'amazon.titan-embed-text-v1'},
@@ -48,6 +48,9 @@ json.dump(application_metadata, open('application_metadata_complete.json', 'w'))
 APP_MD    = json.load(open('application_metadata_complete.json', 'r'))
 MODELS_LLM = {d['name']: d['endpoint'] for d in APP_MD['models-llm']}
 MODELS_EMB = {d['name']: d['endpoint'] for d in APP_MD['models-emb']}
+MODELS_CONTEXT = {d['endpoint']: d['context'] for d in APP_MD['models-llm']} # Context window (tokens) of each LLM endpoint
+MODELS_PROMPT_CACHE = {d['endpoint'] for d in APP_MD['models-llm'] if d.get('prompt_cache')} # LLM endpoints that support Bedrock prompt caching
+RETRIEVAL_MODES = {'Hybrid (BM25 + Vector)': 'hybrid', 'Vector': 'vector', 'Lexical (BM25)': 'lexical'}
 MODEL_SUM = APP_MD['summary_model']
 REGION    = APP_MD['region']
 BUCKET    = APP_MD['datastore']['bucket']
@@ -99,6 +102,7 @@ def select_models(page):
      with st.sidebar:
         llm_model_name = st.selectbox("# :blue[Select LLM Model]", options=MODELS_LLM.keys())
         emb_model_name = st.selectbox("# :blue[Select Embedding Model]", options=MODELS_EMB.keys())
+        retrieval_mode = st.selectbox("# :blue[Select Retrieval Mode]", options=RETRIEVAL_MODES.keys(), help="Lexical answers exact-match questions (part numbers, clause ids) without any embedding call")
         if page == "rag":
             retriever = st.selectbox("# :blue[Select Retriever]", options=["Opensearch","Kendra"])
             if "OpenSearch" in retriever:
@@ -122,7 +126,7 @@ def select_models(page):
             params = {'model_name': llm_model_name, 'endpoint-llm':MODELS_LLM[llm_model_name], "emb_model":emb_model_name, 'endpoint-emb': MODELS_EMB[emb_model_name],'max_len':max_len, 'top_p':top_p, 'temp':temp,'action_name': "Document Query",'Bucket': BUCKET,'Prefix': PREFIX,"rag":retriever,'Region_Name': REGION}
         else:
             params = {'model_name': llm_model_name, 'endpoint-llm':MODELS_LLM[llm_model_name], "emb_model":emb_model_name, 'endpoint-emb': MODELS_EMB[emb_model_name],'max_len':max_len, 'top_p':top_p, 'temp':temp,'action_name': "Document Query",'Bucket': BUCKET,'Prefix': PREFIX,"rag":"",'Region_Name': REGION}
-            
+        params['retrieval_mode'] = RETRIEVAL_MODES[retrieval_mode]
             
      return params
 
@@ -209,28 +213,23 @@ def contact():
                 """, unsafe_allow_html=True)
     
     
-# function to clear the cache and initialize the chat
+# function to clear the current session's chat state and initialize the chat
+# shared caches (extractions, embeddings, summaries) are left untouched so that other sessions keep their cached work
 def clear(greeting=greeting):
     with st.spinner("Clearing all history..."):
-        st.cache_data.clear()
         if 'history' in st.session_state:
             del st.session_state['history']
         if 'pastinp' in st.session_state:
             del st.session_state['pastinp']
         if 'pastresp' in st.session_state:
             del st.session_state['pastresp']
-        if 'summary_flag' in st.session_state:
-            del st.session_state.summary_flag
-        if 'summary_content' in st.session_state:
-             del st.session_state.summary_content
 
         initialize_chat(greeting)
 
 
-# function to clear the cache and initialize the chat
+# function to clear the current session's chat state and initialize the chat
 def clear_new():
     with st.spinner("Clearing all history..."):
-        st.cache_data.clear()
         if 'generated' in st.session_state:
             del st.session_state['generated']
         if 'past' in st.session_state:
@@ -0,0 +1,147 @@
+''' vector_index.py selects and builds the FAISS index type used for a corpus'''
+''' Small corpora use an exact Flat index, larger ones HNSW and very large ones IVF-PQ (trained on a sample) '''
+''' Run "python src/vector_index.py [num_vectors] [dim]" to benchmark recall@k, query latency and memory of each index type'''
+
+import sys # Import sys to read the benchmark arguments
+import time # Import time to measure query latency
+import resource # Import resource to measure resident memory in the benchmark
+import numpy as np # Import numpy for vectors and sampling
+import faiss # Import faiss to build the indexes
+from langchain_community.vectorstores import FAISS # Import FAISS to wrap raw indexes as LangChain vector stores
+from langchain_community.docstore.in_memory import InMemoryDocstore # Import InMemoryDocstore for new vector stores
+from configparser import ConfigParser # Import ConfigParser library for reading the index settings
+
+config_object = ConfigParser()
+config_object.read("config.ini")
+index_type_override=config_object.get("INDEX","index_type",fallback="auto").lower() # auto, flat, hnsw or ivfpq
+hnsw_min_vectors=config_object.getint("INDEX","hnsw_min_vectors",fallback=5000) # Below this an exact search is fast enough
+ivfpq_min_vectors=config_object.getint("INDEX","ivfpq_min_vectors",fallback=200000) # Above this full float32 vectors use too much memory
+hnsw_m=config_object.getint("INDEX","hnsw_m",fallback=32)
+hnsw_ef_search=config_object.getint("INDEX","hnsw_ef_search",fallback=64)
+ivf_nprobe=config_object.getint("INDEX","ivf_nprobe",fallback=16)
+train_sample_size=config_object.getint("INDEX","train_sample_size",fallback=50000) # Vectors used to train IVF-PQ
+'''_________________________________________________________________________________________________________________'''
+
+
+#choose_index_type function to pick the index type for a number of vectors
+#the index_type setting in config.ini overrides the automatic choice
+def choose_index_type(num_vectors):
+    if index_type_override in ("flat", "hnsw", "ivfpq"):
+        return index_type_override
+    if num_vectors >= ivfpq_min_vectors:
+        return "ivfpq"
+    if num_vectors >= hnsw_min_vectors:
+        return "hnsw"
+    return "flat"
+
+
+#build_index function to create (and train if needed) an empty FAISS index
+#parameters: "index_type" is flat, hnsw or ivfpq, "vectors" is the float32 array the index will hold, used for the training sample
+def build_index(index_type, vectors):
+    dim = vectors.shape[1]
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, hnsw_m)
+        index.hnsw.efConstruction = 2 * hnsw_m * 4
+        index.hnsw.efSearch = hnsw_ef_search
+        return index
+    if index_type == "ivfpq" and len(vectors) < 39 * 256: # Too few vectors to train 256 PQ centroids, use an exact index #
+        index_type = "flat"
+    if index_type == "ivfpq":
+        nlist = max(1, int(4 * np.sqrt(len(vectors)))) # Number of inverted lists #
+        m = next(m for m in (dim // 16, dim // 8, dim // 4, dim // 2, dim) if m and dim % m == 0) # Sub-quantizers of 16 dims #
+        index = faiss.IndexIVFPQ(faiss.IndexFlatL2(dim), dim, nlist, m, 8)
+        sample = vectors
+        if len(vectors) > train_sample_size: # Train on a random sample #
+            sample = vectors[np.random.default_rng(0).choice(len(vectors), train_sample_size, replace=False)]
+        index.train(np.ascontiguousarray(sample, dtype=np.float32))
+        index.nprobe = ivf_nprobe
+        return enable_reconstruct(index)
+    return faiss.IndexFlatL2(dim)
+
+
+#enable_reconstruct function to give an IVF index a direct map (id -> list entry), which reconstruct (used by MMR) needs
+#other index types reconstruct without a map. Chunks are still not removed from IVF indexes in place, see remove_from_vector_store
+def enable_reconstruct(index):
+    ivf = faiss.downcast_index(index)
+    if isinstance(ivf, faiss.IndexIVF) and ivf.direct_map.type == faiss.DirectMap.NoMap:
+        ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+    return index
+
+
+#supports_removal function to check whether vectors can be deleted from an index in place, only Flat indexes can
+#HNSW graphs do not support removal, IVF indexes keep the ids of the remaining vectors while LangChain renumbers them (see remove_from_vector_store)
+def supports_removal(index):
+    return isinstance(faiss.downcast_index(index), faiss.IndexFlat)
+'''_________________________________________________________________________________________________________________'''
+
+
+#create_vector_store function to create a LangChain FAISS vector store with the index type chosen for the corpus size
+#parameters: "texts", "vectors" (float32 array) and "metadatas" of the chunks, "embeddings" is used for query embeddings
+#returns: FAISS vector store
+def create_vector_store(texts, vectors, metadatas, embeddings, index_type=None):
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    index = build_index(index_type or choose_index_type(len(vectors)), vectors)
+    db = FAISS(embedding_function=embeddings, index=index, docstore=InMemoryDocstore(), index_to_docstore_id={})
+    db.add_embeddings(list(zip(texts, vectors)), metadatas=metadatas)
+    return db
+
+
+#remove_from_vector_store function to remove chunks from a vector store
+#FAISS.delete renumbers its id -> chunk map compactly, which only matches the index when the index renumbers as well (Flat)
+#other index types are rebuilt from the vectors of the remaining chunks, which the embedding cache returns without new embedding calls
+#parameters: "doc_ids" are docstore ids of the chunks to remove
+#returns: the same store after an in-place delete, otherwise a new store with the remaining chunks
+def remove_from_vector_store(db, doc_ids):
+    if supports_removal(db.index):
+        db.delete(doc_ids)
+        return db
+    removed = set(doc_ids)
+    docs = [db.docstore.search(doc_id) for doc_id in db.index_to_docstore_id.values() if doc_id not in removed]
+    texts = [d.page_content for d in docs]
+    return create_vector_store(texts, db.embedding_function.embed_documents(texts), [d.metadata for d in docs], db.embedding_function)
+
+
+#resize_vector_store function to move a vector store to the index type chosen for its current size
+#used after incremental building, which always starts with a Flat index
+#returns: the same store if the index type already fits, otherwise a new store with the same docstore and ids
+def resize_vector_store(db):
+    index_type = choose_index_type(db.index.ntotal)
+    if index_type == "flat" or not isinstance(faiss.downcast_index(db.index), faiss.IndexFlat):
+        return db
+    vectors = db.index.reconstruct_n(0, db.index.ntotal) # Flat indexes keep the full vectors #
+    index = build_index(index_type, vectors)
+    index.add(vectors)
+    return FAISS(embedding_function=db.embedding_function, index=index, docstore=db.docstore, index_to_docstore_id=db.index_to_docstore_id)
+'''_________________________________________________________________________________________________________________'''
+
+
+#benchmark function to compare the index types on random vectors
+#reports recall@k against the exact Flat results, mean query latency, serialized size and resident memory growth
+def benchmark(num_vectors=20000, dim=1536, num_queries=200, k=4):
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((num_vectors, dim), dtype=np.float32)
+    queries = rng.standard_normal((num_queries, dim), dtype=np.float32)
+    exact = None
+    print(f"{num_vectors} vectors of {dim} dims, {num_queries} queries, k={k}")
+    for index_type in ("flat", "hnsw", "ivfpq"):
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        index = build_index(index_type, vectors)
+        index.add(vectors)
+        build_seconds = time.time() - start
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        for query in queries:
+            _, ids = index.search(query.reshape(1, -1), k)
+        latency_ms = (time.time() - start) / num_queries * 1000
+        _, ids = index.search(queries, k)
+        if exact is None:
+            exact = ids
+        recall = np.mean([len(set(found) & set(truth)) / k for found, truth in zip(ids, exact)])
+        size_mb = faiss.serialize_index(index).nbytes / 1024 / 1024
+        print(f"{index_type:6s} recall@{k}={recall:.3f} query={latency_ms:.2f}ms build={build_seconds:.1f}s index={size_mb:.1f}MB peak_rss+={(rss_after - rss_before) / 1024:.1f}MB")
+        del index
+
+
+if __name__ == "__main__":
+    benchmark(*(int(arg) for arg in sys.argv[1:3]))
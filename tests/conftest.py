@@ -0,0 +1,6 @@
+''' conftest.py puts src on the import path, the modules of RAG_Chatbot import each other by name as "streamlit run src/home.py" does'''
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
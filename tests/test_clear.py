@@ -0,0 +1,34 @@
+''' Regression test: clearing one session's chat must not drop the extractions cached for all sessions, nor another session's state'''
+
+import os
+import shutil
+import streamlit as st
+import cache
+
+
+def test_clear_keeps_shared_cache_and_other_sessions(tmp_path, monkeypatch):
+    shutil.copy(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.ini"), tmp_path)
+    monkeypatch.chdir(tmp_path) # utils writes the application metadata file in the working directory #
+    import utils
+    monkeypatch.setattr(cache, "cache_dir", str(tmp_path))
+    monkeypatch.setattr(cache, "_caches", {})
+    extraction_cache = cache.get_cache("extraction")
+    key = cache.content_hash("check_upload", "test", "Document", ".pdf", b"%PDF shared by both sessions")
+    extraction_cache.set(key, (3, 0, "one two three", True, 3))
+
+    session_a = {'history': ["a"], 'pastinp': ["question of a"], 'pastresp': ["greeting", "answer to a"]}
+    session_b = {'history': ["b"], 'pastinp': ["question of b"], 'pastresp': ["greeting", "answer to b"]}
+    extractions = []
+    @st.cache_data
+    def extract(name): # Stands in for the st.cache_data functions shared by sessions #
+        extractions.append(name)
+        return name.upper()
+    extract("report.pdf")
+
+    monkeypatch.setattr(st, "session_state", session_a) # Session a clicks clear #
+    utils.clear("greeting")
+
+    assert session_a == {'history': [], 'pastinp': [], 'pastresp': ["greeting"]}
+    assert session_b == {'history': ["b"], 'pastinp': ["question of b"], 'pastresp': ["greeting", "answer to b"]}
+    assert extraction_cache.get(key) == (3, 0, "one two three", True, 3)
+    assert extract("report.pdf") == "REPORT.PDF" and extractions == ["report.pdf"] # Served from st.cache_data, not extracted again #
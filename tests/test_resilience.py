@@ -0,0 +1,107 @@
+''' Tests of resilient_call against a stubbed Bedrock client that throttles, fails or hangs, no request is sent to AWS'''
+
+import time
+from collections import Counter
+import pytest
+from botocore.exceptions import ClientError, EndpointConnectionError, ReadTimeoutError
+import admission
+import resilience
+
+
+# StubClient raises the given error code (or the given botocore error) on the first "failures" calls of a model, then answers #
+class StubClient:
+    def __init__(self, failures=0, code="ThrottlingException", models=("primary",), delay=0.0, error=None):
+        self.failures = failures
+        self.code = code
+        self.error = error
+        self.models = models
+        self.delay = delay
+        self.calls = Counter()
+
+    def invoke_model(self, modelId):
+        self.calls[modelId] += 1
+        time.sleep(self.delay)
+        if modelId in self.models and self.calls[modelId] <= self.failures:
+            if self.error is not None:
+                raise self.error
+            raise ClientError({'Error': {'Code': self.code, 'Message': 'stubbed'}}, 'InvokeModel')
+        return f"answer from {modelId}"
+
+
+@pytest.fixture(autouse=True)
+def isolated(monkeypatch):
+    monkeypatch.setattr(admission, "admission_enabled", False)
+    monkeypatch.setattr(resilience, "base_delay", 0.001)
+    monkeypatch.setattr(resilience, "_metrics", Counter())
+    monkeypatch.setattr(resilience, "fallback_chains", {"primary": ["fallback"]})
+
+
+def test_throttled_calls_are_retried_on_the_same_model():
+    client = StubClient(failures=2)
+    response, served_by = resilience.resilient_call(client.invoke_model, "primary")
+    assert (response, served_by) == ("answer from primary", "primary")
+    assert resilience.metrics() == {"primary": {'calls': 3, 'throttles': 2, 'retries': 2}}
+
+
+def test_model_throttled_on_every_attempt_falls_back():
+    client = StubClient(failures=resilience.max_attempts)
+    response, served_by = resilience.resilient_call(client.invoke_model, "primary")
+    assert (response, served_by) == ("answer from fallback", "fallback")
+    metrics = resilience.metrics()
+    assert metrics["primary"] == {'calls': resilience.max_attempts, 'throttles': resilience.max_attempts,
+                                  'retries': resilience.max_attempts - 1, 'fallbacks': 1}
+    assert metrics["fallback"] == {'calls': 1}
+
+
+def test_no_fallback_when_fallbacks_are_disabled():
+    client = StubClient(failures=resilience.max_attempts)
+    with pytest.raises(ClientError):
+        resilience.resilient_call(client.invoke_model, "primary", use_fallbacks=False)
+    assert resilience.metrics()["primary"]['failures'] == 1
+    assert client.calls["fallback"] == 0
+
+
+def test_failure_when_the_whole_chain_is_throttled():
+    client = StubClient(failures=resilience.max_attempts, models=("primary", "fallback"))
+    with pytest.raises(ClientError):
+        resilience.resilient_call(client.invoke_model, "primary")
+    metrics = resilience.metrics()
+    assert metrics["primary"]['fallbacks'] == 1
+    assert metrics["primary"]['failures'] == 1
+    assert metrics["fallback"]['throttles'] == resilience.max_attempts
+
+
+def test_non_retryable_error_is_raised_at_once():
+    client = StubClient(failures=1, code="ValidationException")
+    with pytest.raises(ClientError) as error:
+        resilience.resilient_call(client.invoke_model, "primary")
+    assert error.value.response['Error']['Code'] == "ValidationException"
+    assert resilience.metrics() == {"primary": {'calls': 1, 'failures': 1}}
+    assert client.calls["fallback"] == 0
+
+
+def test_connection_errors_are_retried():
+    for error in (EndpointConnectionError(endpoint_url="https://bedrock-runtime"), ReadTimeoutError(endpoint_url="https://bedrock-runtime")):
+        resilience._metrics.clear()
+        client = StubClient(failures=2, error=error)
+        response, served_by = resilience.resilient_call(client.invoke_model, "primary")
+        assert (response, served_by) == ("answer from primary", "primary")
+        assert resilience.metrics() == {"primary": {'calls': 3, 'connection_errors': 2, 'retries': 2}}
+
+
+def test_connection_error_on_every_attempt_is_raised():
+    client = StubClient(failures=resilience.max_attempts, error=EndpointConnectionError(endpoint_url="https://bedrock-runtime"))
+    with pytest.raises(EndpointConnectionError):
+        resilience.resilient_call(client.invoke_model, "primary")
+    assert resilience.metrics()["primary"] == {'calls': resilience.max_attempts, 'connection_errors': resilience.max_attempts,
+                                               'retries': resilience.max_attempts - 1, 'failures': 1}
+    assert client.calls["fallback"] == 0
+
+
+def test_deadline_stops_a_slow_call():
+    client = StubClient(delay=1.0)
+    start = time.time()
+    with pytest.raises(TimeoutError):
+        resilience.resilient_call(client.invoke_model, "primary", deadline=0.2)
+    assert time.time() - start < 0.9
+    assert resilience.metrics() == {"primary": {'calls': 1, 'deadline_exceeded': 1, 'failures': 1}}
@@ -0,0 +1,80 @@
+''' Tests of chunk removal from FAISS vector stores, with stub embeddings so no request is sent to AWS'''
+
+import numpy as np
+import faiss
+from langchain_core.embeddings import Embeddings
+from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
+import vector_index
+
+
+# StubEmbeddings returns a fixed random vector per text, as the embedding cache returns the stored vector of a chunk #
+class StubEmbeddings(Embeddings):
+    def __init__(self, texts, dim=32):
+        vectors = np.random.default_rng(0).standard_normal((len(texts), dim), dtype=np.float32)
+        self.vectors = dict(zip(texts, vectors))
+
+    def embed_documents(self, texts):
+        return [self.vectors[text].tolist() for text in texts]
+
+    def embed_query(self, text):
+        return self.vectors[text].tolist()
+
+
+# ivfpq_store builds a small IVF-PQ store (4 lists searched exhaustively, 4-bit codes) that finds every chunk at rank 1 #
+def ivfpq_store(texts, embeddings):
+    vectors = np.array(embeddings.embed_documents(texts), dtype=np.float32)
+    index = faiss.IndexIVFPQ(faiss.IndexFlatL2(vectors.shape[1]), vectors.shape[1], 4, 8, 4)
+    index.train(vectors)
+    index.nprobe = 4
+    db = FAISS(embedding_function=embeddings, index=vector_index.enable_reconstruct(index), docstore=InMemoryDocstore(), index_to_docstore_id={})
+    db.add_embeddings(list(zip(texts, vectors)), metadatas=[{"chunk": i} for i in range(len(texts))])
+    return db
+
+
+def self_hits(db, texts):
+    return sum(db.similarity_search_by_vector(db.embedding_function.embed_query(text), k=1)[0].page_content == text for text in texts)
+
+
+def test_only_flat_indexes_support_removal():
+    vectors = np.zeros((1, 32), dtype=np.float32)
+    assert vector_index.supports_removal(vector_index.build_index("flat", vectors))
+    assert not vector_index.supports_removal(vector_index.build_index("hnsw", vectors))
+    texts = [f"chunk {i}" for i in range(200)]
+    assert not vector_index.supports_removal(ivfpq_store(texts, StubEmbeddings(texts)).index)
+
+
+def test_retrieval_after_removal_from_ivfpq():
+    texts = [f"chunk {i}" for i in range(200)]
+    db = ivfpq_store(texts, StubEmbeddings(texts))
+    assert self_hits(db, texts) == 200
+    doc_ids = list(db.index_to_docstore_id.values())
+    db = vector_index.remove_from_vector_store(db, doc_ids[:20])
+    assert db.index.ntotal == len(db.index_to_docstore_id) == 180
+    assert self_hits(db, texts[20:]) == 180
+    db.add_embeddings([("new chunk", np.ones(32, dtype=np.float32))]) # Added chunks do not take the ids of existing ones #
+    assert self_hits(db, texts[20:]) == 180
+
+
+def test_removal_from_flat_is_in_place():
+    texts = [f"chunk {i}" for i in range(50)]
+    embeddings = StubEmbeddings(texts)
+    db = vector_index.create_vector_store(texts, embeddings.embed_documents(texts), [{} for _ in texts], embeddings, index_type="flat")
+    updated = vector_index.remove_from_vector_store(db, list(db.index_to_docstore_id.values())[:5])
+    assert updated is db
+    assert self_hits(db, texts[5:]) == 45
+
+
+def mmr_first_hits(db, texts):
+    return sum(db.max_marginal_relevance_search_by_vector(db.embedding_function.embed_query(text), k=4, fetch_k=20)[0].page_content == text for text in texts)
+
+
+def test_mmr_after_removal_from_ivfpq():
+    texts = [f"chunk {i}" for i in range(200)]
+    db = ivfpq_store(texts, StubEmbeddings(texts))
+    assert mmr_first_hits(db, texts[:40]) == 40 # MMR reconstructs the IVF-PQ candidates through the direct map #
+    db = vector_index.remove_from_vector_store(db, list(db.index_to_docstore_id.values())[:20])
+    assert mmr_first_hits(db, texts[20:]) == 180
+    for text in texts[20:40]:
+        docs = db.max_marginal_relevance_search_by_vector(db.embedding_function.embed_query(text), k=4, fetch_k=20)
+        assert all(doc.metadata["chunk"] >= 20 for doc in docs)